@@ -0,0 +1,275 @@
+import heapq
+import unittest
+
+
+class Leg(object):
+    """
+    One conversion of a cycle on `book` (base_quote). `levels` is the depth on
+    the side being taken: asks for a buy, bids for a sell, best first, as
+    (price, amount) with amount in the base currency.
+    """
+
+    def __init__(self, book, side, levels, fee=0.0):
+        self.book = book
+        self.side = side
+        self.levels = levels
+        self.fee = fee
+        self.base, self.quote = book.split('_')
+
+    @property
+    def spends(self):
+        return self.quote if self.side == 'buy' else self.base
+
+    @property
+    def receives(self):
+        return self.base if self.side == 'buy' else self.quote
+
+    def convert(self, amount_in, consumed=0.0):
+        """
+        Walk the depth starting after `consumed` base units. Returns
+        (amount_out, major, worst_price), or None if the book is too thin.
+        """
+        major = 0.0
+        out = 0.0
+        remaining = amount_in
+        worst = None
+        skip = consumed
+        for price, amount in self.levels:
+            if skip >= amount:
+                skip -= amount
+                continue
+            available = amount - skip
+            skip = 0
+            if self.side == 'buy':
+                take = min(available, remaining / price)
+                remaining -= take * price
+                out += take
+            else:
+                take = min(available, remaining)
+                remaining -= take
+                out += take * price
+            major += take
+            worst = price
+            if remaining <= 1e-12:
+                return out * (1 - self.fee), major, worst
+        return None
+
+
+class Cycle(object):
+    """A route starting and ending in `start`, e.g. mxn -> eth -> btc -> mxn."""
+
+    def __init__(self, name, start, legs):
+        self.name = name
+        self.start = start
+        self.legs = legs
+
+    def simulate(self, amount, consumed):
+        """Push `amount` of the start currency through every leg."""
+        flows = []
+        current = amount
+        for leg in self.legs:
+            result = leg.convert(current, consumed.get((leg.book, leg.side), 0.0))
+            if result is None:
+                return None
+            out, major, worst = result
+            flows.append((current, major, worst))
+            current = out
+        return current - amount, flows
+
+
+class CapitalAllocator(object):
+    """
+    Splits shared balances across every concurrently profitable cycle.
+
+    Capital is handed out in steps, each to the cycle with the best profit
+    per unit for its next step given the depth already used by earlier
+    steps (on any cycle sharing the book). A cycle leaves the pool once its
+    next step is unprofitable, would overdraw a balance, or would push an
+    order over the book's maximum_amount. The first step of a cycle is sized
+    so every leg meets the book's minimum_amount. Profit is concave in size
+    along a depth curve, so for a single shared currency this greedy split is
+    optimal; across currencies it is a fast approximation.
+    """
+
+    def __init__(self, book_info, steps=50, balance_ratio=0.8):
+        self.book_info = book_info
+        self.steps = steps
+        self.balance_ratio = balance_ratio
+
+    def _minimum_input(self, cycle, step):
+        """Smallest input for which every leg meets its book's minimum_amount."""
+        result = cycle.simulate(step, {})
+        if result is None:
+            return None
+        _, flows = result
+        needed = 0.0
+        for leg, (_, major, _) in zip(cycle.legs, flows):
+            minimum = self.book_info.get(leg.book, {}).get('minimum_amount', 0)
+            if major > 0:
+                needed = max(needed, step * minimum / major * 1.0001)
+        return needed
+
+    def _feasible(self, cycle, flows, budgets, majors):
+        spend = {}
+        for leg, (amount_in, major, _) in zip(cycle.legs, flows):
+            spend[leg.spends] = spend.get(leg.spends, 0.0) + amount_in
+            maximum = self.book_info.get(leg.book, {}).get('maximum_amount', float('inf'))
+            if majors[cycle.name][leg.book] + major > maximum:
+                return False
+        return all(budgets.get(currency, 0.0) >= amount for currency, amount in spend.items())
+
+    def allocate(self, cycles, balances, threshold=1):
+        """
+        Only steps whose return (output / input) beats `threshold` are funded.
+        Returns one allocation per funded cycle:
+        {'cycle', 'input', 'profit', 'orders': [{'book', 'side', 'major', 'price', 'type'}]}
+        """
+        budgets = {currency: amount * self.balance_ratio for currency, amount in balances.items()}
+        consumed = {}
+        majors = {cycle.name: {leg.book: 0.0 for leg in cycle.legs} for cycle in cycles}
+        totals = {cycle.name: {'input': 0.0, 'profit': 0.0, 'prices': {}} for cycle in cycles}
+        step_size = {}
+        floors = {}
+        heap = []
+        for index, cycle in enumerate(cycles):
+            step = budgets.get(cycle.start, 0.0) / self.steps
+            if step <= 0:
+                continue
+            step_size[cycle.name] = step
+            minimum = self._minimum_input(cycle, step)
+            if minimum is None:
+                continue
+            floors[cycle.name] = minimum
+            first = max(step, minimum)
+            result = cycle.simulate(first, consumed)
+            heapq.heappush(heap, (-result[0] / first if result else 0, index, first))
+
+        while heap:
+            _, index, amount = heapq.heappop(heap)
+            cycle = cycles[index]
+            result = cycle.simulate(amount, consumed)
+            fits = result is not None and result[0] > amount * (threshold - 1)
+            if fits:
+                profit, flows = result
+                rate = profit / amount
+                # depth may have been used by another cycle since this was pushed
+                if heap and rate < -heap[0][0]:
+                    heapq.heappush(heap, (-rate, index, amount))
+                    continue
+                fits = self._feasible(cycle, flows, budgets, majors)
+            if not fits:
+                # the step runs past the profitable depth, a balance or a
+                # maximum_amount, a smaller one may still fit
+                if amount / 2 >= floors[cycle.name]:
+                    heapq.heappush(heap, (0, index, amount / 2))
+                continue
+            for leg, (amount_in, major, worst) in zip(cycle.legs, flows):
+                budgets[leg.spends] -= amount_in
+                key = (leg.book, leg.side)
+                consumed[key] = consumed.get(key, 0.0) + major
+                majors[cycle.name][leg.book] += major
+                totals[cycle.name]['prices'][leg.book] = worst
+            totals[cycle.name]['input'] += amount
+            totals[cycle.name]['profit'] += profit
+            floors[cycle.name] = step_size[cycle.name] / 64
+            step = step_size[cycle.name]
+            following = cycle.simulate(step, consumed)
+            heapq.heappush(heap, (-following[0] / step if following else 0, index, step))
+
+        allocations = []
+        for cycle in cycles:
+            total = totals[cycle.name]
+            if total['input'] <= 0:
+                continue
+            allocations.append({
+                'cycle': cycle.name,
+                'input': total['input'],
+                'profit': total['profit'],
+                'orders': [
+                    {
+                        'book': leg.book,
+                        'major': round(majors[cycle.name][leg.book], 8),
+                        'side': leg.side,
+                        'price': total['prices'][leg.book],
+                        'type': 'limit',
+                    }
+                    for leg in cycle.legs
+                ],
+            })
+        allocations.sort(key=lambda allocation: allocation['profit'], reverse=True)
+        return allocations
+
+
+class TestCapitalAllocator(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.book_info = {
+            'eth_mxn': {'minimum_amount': 0.001, 'maximum_amount': 100},
+            'eth_btc': {'minimum_amount': 0.001, 'maximum_amount': 100},
+            'btc_mxn': {'minimum_amount': 0.0001, 'maximum_amount': 10},
+        }
+        return super().setUp()
+
+    def bid_cycle(self, eth_ask=40000, eth_btc_bid=0.06, btc_bid=700000, depth=1.0):
+        # mxn -> eth -> btc -> mxn
+        return Cycle('bid', 'mxn', [
+            Leg('eth_mxn', 'buy', [(eth_ask, depth), (eth_ask * 1.03, depth)]),
+            Leg('eth_btc', 'sell', [(eth_btc_bid, depth), (eth_btc_bid * 0.97, depth)]),
+            Leg('btc_mxn', 'sell', [(btc_bid, depth), (btc_bid * 0.97, depth)]),
+        ])
+
+    def test_unprofitable_cycle_gets_nothing(self):
+        cycle = self.bid_cycle(btc_bid=600000)
+        allocator = CapitalAllocator(self.book_info)
+        self.assertEqual(allocator.allocate([cycle], {'mxn': 10000, 'eth': 1, 'btc': 1}), [])
+
+    def test_respects_balances(self):
+        balances = {'mxn': 10000, 'eth': 1, 'btc': 1}
+        allocator = CapitalAllocator(self.book_info)
+        allocations = allocator.allocate([self.bid_cycle()], balances)
+        self.assertEqual(len(allocations), 1)
+        self.assertLessEqual(allocations[0]['input'], balances['mxn'] * 0.8 + 1e-6)
+        self.assertGreater(allocations[0]['profit'], 0)
+        orders = allocations[0]['orders']
+        self.assertEqual([o['book'] for o in orders], ['eth_mxn', 'eth_btc', 'btc_mxn'])
+        for order in orders:
+            self.assertGreaterEqual(order['major'], self.book_info[order['book']]['minimum_amount'])
+
+    def test_stops_at_depth_where_profit_ends(self):
+        # second level of every book makes the cycle lose money
+        balances = {'mxn': 100000, 'eth': 100, 'btc': 100}
+        allocator = CapitalAllocator(self.book_info, steps=1000)
+        allocation = allocator.allocate([self.bid_cycle(depth=0.1)], balances)[0]
+        # at most one step (80 mxn, 0.002 eth) straddles into the losing level
+        self.assertGreater(allocation['orders'][0]['major'], 0.09)
+        self.assertLessEqual(allocation['orders'][0]['major'], 0.1 + 0.002)
+
+    def test_splits_between_cycles_sharing_a_balance(self):
+        balances = {'mxn': 200000, 'eth': 100, 'btc': 100, 'xrp': 0}
+        rich = self.bid_cycle(depth=0.5)
+        other = Cycle('other', 'mxn', [
+            Leg('btc_mxn', 'buy', [(690000, 0.1)]),
+            Leg('eth_btc', 'buy', [(0.055, 10.0)]),
+            Leg('eth_mxn', 'sell', [(40000, 10.0)]),
+        ])
+        allocations = CapitalAllocator(self.book_info).allocate([rich, other], balances)
+        self.assertEqual({a['cycle'] for a in allocations}, {'bid', 'other'})
+        spent = sum(a['input'] for a in allocations)
+        self.assertLessEqual(spent, balances['mxn'] * 0.8 + 1e-6)
+
+    def test_threshold_above_route_return(self):
+        balances = {'mxn': 10000, 'eth': 1, 'btc': 1}
+        allocator = CapitalAllocator(self.book_info)
+        # the top of the books returns 5%
+        self.assertTrue(allocator.allocate([self.bid_cycle()], balances, threshold=1.04))
+        self.assertEqual(allocator.allocate([self.bid_cycle()], balances, threshold=1.06), [])
+
+    def test_respects_maximum_amount(self):
+        self.book_info['btc_mxn']['maximum_amount'] = 0.01
+        balances = {'mxn': 10 ** 6, 'eth': 100, 'btc': 100}
+        allocation = CapitalAllocator(self.book_info).allocate([self.bid_cycle()], balances)[0]
+        self.assertLessEqual(allocation['orders'][2]['major'], 0.01)
+
+
+if __name__ == '__main__':
+    unittest.main()
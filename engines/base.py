@@ -1,38 +1,135 @@
 from abc import ABCMeta, abstractmethod
 import json
+import grequests
+
+class ExchangeEngineBase(metaclass=ABCMeta):
+    '''
+    Every venue speaks the same normalized interface: books are named
+    'base_quote' in lower case, request methods return grequests-style
+    requests whose responses carry the normalized result in `.parsed`, and
+    `map` sends a batch of them concurrently. A failed request maps to None,
+    a request the venue rejected has `.parsed` None. A venue missing any of
+    the abstract methods fails at instantiation.
+    '''
+    name = 'exchange'
+    feeRatio = 0.0
+    # TickerHistory the book hooks append every quote to, set per instance
+    history = None
 
-class ExchangeEngineBase:
-    __metaclass__ = ABCMeta
     @abstractmethod
     def __init__(self):
         pass
-    
+
     def load_key(self, filename):
-        with open(filename) as f:    
+        with open(filename) as f:
             self.key = json.load(f)
-            
+
     @abstractmethod
     def _send_request(self):
         pass
-    
+
+    def map(self, requests):
+        return grequests.map(requests)
+
+    '''
+    Taker fee for the book as a fraction, e.g. 0.0026
+    '''
+    def taker_fee(self, book):
+        return self.feeRatio
+
+    '''
+    Requests that refresh the data taker_fee reads, empty when it is current.
+    CrossVenueRunner sends them along with each quote fan out.
+    '''
+    def fee_requests(self, books):
+        return []
+
+    '''
+    Body: {'book': 'btc_mxn', 'side': 'buy', 'major': 0.01, 'price': 700000, 'type': 'limit'}
+    Parsed: {'oid': 'abc'}
+    '''
     @abstractmethod
-    def place_order(self, ticker, action, amount, price):
+    def place_order(self, body):
         pass
-  
+
+    '''
+    Parsed: ['abc'], the cancelled oids
+    '''
+    @abstractmethod
+    def cancel_order(self, oid):
+        pass
+
+    '''
+    Parsed: ['abc', ...], the cancelled oids
+    '''
+    @abstractmethod
+    def cancel_all_orders(self):
+        pass
+
+    '''
+    Parsed: [{'oid': 'abc', 'book': 'btc_mxn', 'side': 'buy', 'price': p, 'amount': unfilled,
+              'original_amount': a, 'status': 'open'}, ...]
+    '''
+    @abstractmethod
+    def list_open_orders(self, book=None):
+        pass
+
+    '''
+    Parsed: the order in list_open_orders format, inside a list, whether it
+    is still open or not
+    '''
     @abstractmethod
-    def get_balance(self):
+    def lookup_order(self, oid):
         pass
-    
-    
+
+    '''
+    Parsed: {'btc_mxn': {'taker_fee': 0.0065, 'maker_fee': 0.005}}, as fractions
+    '''
+    @abstractmethod
+    def list_fees(self, books=[]):
+        pass
+
+    '''
+    Parsed: {'mxn': 1000.0, 'btc': 0.5}, available amounts
+    '''
+    @abstractmethod
+    def get_balance(self, tickers=[]):
+        pass
+
+    '''
+    Parsed: {'book': 'btc_mxn', 'bid': {'price': p, 'amount': a}, 'ask': {'price': p, 'amount': a}},
+    a side is missing when the book is empty
+    '''
+    @abstractmethod
+    def get_order_book_innermost(self, book):
+        pass
+
+    '''
+    Parsed: {'book': 'btc_mxn', 'bids': [(price, amount), ...], 'asks': [(price, amount), ...]}, best first
+    '''
+    @abstractmethod
+    def get_order_book_depth(self, book, levels=20):
+        pass
+
+    '''
+    Parsed: {'btc_mxn': {'minimum_amount': 0.00003, 'maximum_amount': 3000.0, ...}}
+    '''
+    @abstractmethod
+    def get_available_books(self, books=[]):
+        pass
+
+    '''
+    Rows of (time, bid, ask, last) for the ticker, oldest first
+    '''
     #@abstractmethod
-    def get_ticker_history(self, ticker):
+    def get_ticker_history(self, ticker, window=None):
         pass
-    
-   
-       
+
+
+
     '''
     Format: e.g. {'exchange': 'gatecoin', 'ticker': 'BTCHKD', 'data': [{price: (int)30.5}]}
     '''
     #@abstractmethod
     def parseTickerData(self, tickerData):
-        pass
\ No newline at end of file
+        pass
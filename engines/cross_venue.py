@@ -0,0 +1,443 @@
+import time
+import unittest
+import gevent
+from engines.base import ExchangeEngineBase
+from engines.history import TickerHistory
+from engines.scheduler import PollScheduler
+
+
+class CrossVenueRunner(object):
+    """
+    Quotes the same books on several engines at once and evaluates every
+    route over the combined quotes:
+
+    - cross venue: buy a book on the venue with the cheapest ask and sell it
+      on the one with the richest bid
+    - triangular: the bid and ask routes of each (A, B, C) triangle, the same
+      maths as CryptoEngineTriArbitrage, with every leg taken on whichever
+      venue quotes it best (a single venue triangle is the special case)
+
+    Each venue's batch runs in its own greenlet, so a fan out takes as long
+    as the slowest venue rather than the sum of them.
+
+    Following more books than a venue's rate limit allows polling every
+    round, give it a PollScheduler in `schedulers`: each round then polls
+    only the books that are due, the rest keep their last quote, and every
+    evaluation feeds the route values back so books on routes close to the
+    threshold are polled more often. A kept quote is dropped once it is
+    older than the scheduler's max_interval.
+    """
+
+    def __init__(self, engines, books, triangles=(), timeout=None, schedulers=None):
+        self.engines = engines
+        self.books = list(books)
+        self.triangles = [tuple(triangle) for triangle in triangles]
+        self.timeout = timeout
+        self.schedulers = schedulers or {}
+        # {venue: {book: (poll time, innermost book)}} for scheduled venues
+        self.last_quotes = {name: {} for name in engines}
+
+    def _quote_venue(self, name, engine):
+        # fee data is refreshed here so evaluate never blocks on it
+        fees = engine.fee_requests(self.books)
+        scheduler = self.schedulers.get(name)
+        if scheduler is not None:
+            if fees:
+                engine.map(fees)
+            polled = scheduler.poll()
+            now = scheduler.clock()
+            last = self.last_quotes[name]
+            last.update((book, (now, quote)) for book, quote in polled.items())
+            for book in [book for book, (ts, _) in last.items() if now - ts > scheduler.max_interval]:
+                del last[book]
+            return {book: quote for book, (_, quote) in last.items()}
+        requests = [engine.get_order_book_innermost(book=book) for book in self.books]
+        responses = engine.map(requests + fees)
+        return {
+            book: res.parsed for book, res in zip(self.books, responses) if res is not None
+        }
+
+    def quote(self):
+        """{venue: {book: innermost book}}, venues that failed, timed out or returned nothing are left out."""
+        jobs = {name: gevent.spawn(self._quote_venue, name, engine) for name, engine in self.engines.items()}
+        gevent.joinall(list(jobs.values()), timeout=self.timeout)
+        quotes = {}
+        for name, job in jobs.items():
+            if job.successful() and job.value:
+                quotes[name] = job.value
+            else:
+                job.kill(block=False)
+        return quotes
+
+    def best(self, quotes, book, side):
+        """Best (venue, price, amount) for taking `side` ('bid' or 'ask') of the book."""
+        candidates = [
+            (venue, books[book][side]['price'], books[book][side]['amount'])
+            for venue, books in quotes.items()
+            if book in books and side in books[book]
+        ]
+        if not candidates:
+            return None
+        if side == 'ask':
+            return min(candidates, key=lambda candidate: candidate[1])
+        return max(candidates, key=lambda candidate: candidate[1])
+
+    def _fee_factor(self, venue, book):
+        return 1 - self.engines[venue].taker_fee(book)
+
+    def _leg(self, quote, book, side):
+        venue, price, amount = quote
+        return {'venue': venue, 'book': book, 'side': side, 'price': price, 'amount': amount}
+
+    def cross_venue_routes(self, quotes):
+        routes = []
+        for book in self.books:
+            ask = self.best(quotes, book, 'ask')
+            bid = self.best(quotes, book, 'bid')
+            if ask is None or bid is None or ask[0] == bid[0]:
+                continue
+            value = bid[1] / ask[1] * self._fee_factor(ask[0], book) * self._fee_factor(bid[0], book)
+            routes.append({
+                'type': 'cross_venue',
+                'route': f"{book}:{ask[0]}->{bid[0]}",
+                'value': value,
+                'legs': [self._leg(ask, book, 'buy'), self._leg(bid, book, 'sell')],
+            })
+        return routes
+
+    def triangular_routes(self, quotes):
+        routes = []
+        for a, b, c in self.triangles:
+            # bid route: buy A, sell B, sell C
+            legs = [(a, 'ask', 'buy'), (b, 'bid', 'sell'), (c, 'bid', 'sell')]
+            best = [self.best(quotes, book, side) for book, side, _ in legs]
+            if None not in best:
+                value = 1 / best[0][1] * best[1][1] * best[2][1]
+                routes.append(self._triangle('bid', (a, b, c), legs, best, value))
+            # ask route: sell A, buy B, buy C
+            legs = [(a, 'bid', 'sell'), (b, 'ask', 'buy'), (c, 'ask', 'buy')]
+            best = [self.best(quotes, book, side) for book, side, _ in legs]
+            if None not in best:
+                value = 1 / best[2][1] / best[1][1] * best[0][1]
+                routes.append(self._triangle('ask', (a, b, c), legs, best, value))
+        return routes
+
+    def _triangle(self, name, triangle, legs, best, value):
+        for (book, _, _), quote in zip(legs, best):
+            value *= self._fee_factor(quote[0], book)
+        return {
+            'type': 'triangular',
+            'route': f"{'-'.join(triangle)}:{name}",
+            'value': value,
+            'legs': [self._leg(quote, book, action) for (book, _, action), quote in zip(legs, best)],
+        }
+
+    def evaluate(self, quotes=None, threshold=1):
+        """Every route, most valuable first. A value above 1 is profitable after fees."""
+        quotes = self.quote() if quotes is None else quotes
+        routes = self.cross_venue_routes(quotes) + self.triangular_routes(quotes)
+        self.update_schedulers(routes, threshold)
+        return sorted(routes, key=lambda route: route['value'], reverse=True)
+
+    def update_schedulers(self, routes, threshold):
+        # each venue's scheduler sees the best route through its books
+        best = {}
+        for route in routes:
+            books = tuple(leg['book'] for leg in route['legs'])
+            for venue in {leg['venue'] for leg in route['legs']}:
+                if venue in self.schedulers:
+                    best[venue, books] = max(best.get((venue, books), 0), route['value'])
+        for (venue, books), value in best.items():
+            self.schedulers[venue].update_route(books, value, threshold)
+
+    def opportunities(self, threshold=1):
+        return [route for route in self.evaluate(threshold=threshold) if route['value'] > threshold]
+
+    def run(self, threshold=1, tick=1, rounds=None):
+        """
+        Polling loop, yields the opportunities of each round. With schedulers
+        a short `tick` is fine, they decide which books are actually polled.
+        """
+        count = 0
+        while rounds is None or count < rounds:
+            yield self.opportunities(threshold)
+            count += 1
+            gevent.sleep(tick)
+
+
+class _MockResponse(object):
+    status_code = 200
+
+    def __init__(self, parsed):
+        self.parsed = parsed
+
+
+class _MockRequest(object):
+
+    def __init__(self, venue, build):
+        self.venue = venue
+        self.build = build
+        self.response = None
+
+    def send(self, **kwargs):
+        gevent.sleep(self.venue.latency)
+        if self.venue.down:
+            return self
+        self.response = _MockResponse(self.build())
+        return self
+
+
+class MockVenue(ExchangeEngineBase):
+    """Local venue answering from `quotes` after `latency` seconds."""
+
+    def __init__(self, name, quotes, latency=0.0, fee=0.0, down=False, balances=None):
+        self.name = name
+        self.quotes = quotes
+        self.latency = latency
+        self.feeRatio = fee
+        self.down = down
+        self.balances = balances or {}
+        self.orders = {}
+        # orders no longer on the book, see fill
+        self.closed = {}
+        self.requests = 0
+        self.history = TickerHistory()
+
+    def map(self, requests):
+        jobs = [gevent.spawn(req.send) for req in requests]
+        try:
+            gevent.joinall(jobs)
+        finally:
+            gevent.killall(jobs, block=False)
+        return [req.response for req in requests]
+
+    def _send_request(self, build):
+        self.requests += 1
+        return _MockRequest(self, build)
+
+    def place_order(self, body):
+        def build():
+            oid = f"{self.name}-{len(self.orders) + 1}"
+            self.orders[oid] = body
+            return {'oid': oid}
+        return self._send_request(build)
+
+    def _cancel(self, oid):
+        order = self.orders.pop(oid)
+        self.closed[oid] = self._order(oid, order, order['major'], 'cancelled')
+
+    def cancel_order(self, oid):
+        def build():
+            if oid not in self.orders:
+                return []
+            self._cancel(oid)
+            return [oid]
+        return self._send_request(build)
+
+    def cancel_all_orders(self):
+        def build():
+            oids = list(self.orders)
+            for oid in oids:
+                self._cancel(oid)
+            return oids
+        return self._send_request(build)
+
+    def _order(self, oid, order, unfilled, status):
+        return {'oid': oid, 'book': order['book'], 'side': order['side'], 'price': order.get('price'),
+                'amount': unfilled, 'original_amount': order['major'], 'status': status}
+
+    def fill(self, oid):
+        """Fill a resting order completely, taking it off the book."""
+        self.closed[oid] = self._order(oid, self.orders.pop(oid), 0.0, 'completed')
+
+    def list_open_orders(self, book=None):
+        return self._send_request(lambda: [
+            self._order(oid, order, order['major'], 'open')
+            for oid, order in self.orders.items()
+            if book is None or order['book'] == book
+        ])
+
+    def lookup_order(self, oid):
+        def build():
+            if oid in self.orders:
+                return [self._order(oid, self.orders[oid], self.orders[oid]['major'], 'open')]
+            return [self.closed[oid]] if oid in self.closed else []
+        return self._send_request(build)
+
+    def list_fees(self, books=[]):
+        return self._send_request(lambda: {
+            book: {'taker_fee': self.feeRatio, 'maker_fee': self.feeRatio}
+            for book in self.quotes if not books or book in books
+        })
+
+    def get_balance(self, tickers=[]):
+        return self._send_request(lambda: {
+            ticker: amount for ticker, amount in self.balances.items()
+            if not tickers or ticker in tickers
+        })
+
+    def get_order_book_innermost(self, book):
+        def build():
+            quote = self.quotes[book]
+            self.history.append(book, bid=quote.get('bid', {}).get('price', float('nan')),
+                                ask=quote.get('ask', {}).get('price', float('nan')))
+            return dict(quote, book=book)
+        return self._send_request(build)
+
+    def get_order_book_depth(self, book, levels=20):
+        def build():
+            quote = self.quotes[book]
+            return {
+                'book': book,
+                'bids': [(quote['bid']['price'], quote['bid']['amount'])] if 'bid' in quote else [],
+                'asks': [(quote['ask']['price'], quote['ask']['amount'])] if 'ask' in quote else [],
+            }
+        return self._send_request(build)
+
+    def get_available_books(self, books=[]):
+        return self._send_request(lambda: {
+            book: {'minimum_amount': 0.0, 'maximum_amount': float('inf')}
+            for book in self.quotes if not books or book in books
+        })
+
+
+class _FeeVenue(MockVenue):
+    """Mock venue whose per book fees have to be fetched, like Bitso's."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fees = {}
+        self.fee_fetches = 0
+
+    def taker_fee(self, book):
+        return self.fees.get(book, self.feeRatio)
+
+    def fee_requests(self, books):
+        if all(book in self.fees for book in books):
+            return []
+
+        def build():
+            self.fee_fetches += 1
+            self.fees.update({book: 0.002 for book in books})
+            return self.fees
+        return [self._send_request(build)]
+
+
+def _quote(bid, ask, amount=1.0):
+    return {'bid': {'price': bid, 'amount': amount}, 'ask': {'price': ask, 'amount': amount}}
+
+
+class TestCrossVenueRunner(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.books = ['eth_mxn', 'eth_btc', 'btc_mxn']
+        fair = {
+            'eth_mxn': _quote(39990, 40010),
+            'eth_btc': _quote(0.05713, 0.05716),
+            'btc_mxn': _quote(699900, 700100),
+        }
+        self.fast = MockVenue('fast', fair, latency=0.05)
+        self.slow = MockVenue('slow', dict(fair, btc_mxn=_quote(703000, 703500)), latency=0.2)
+        self.runner = CrossVenueRunner({'fast': self.fast, 'slow': self.slow}, self.books,
+                                       triangles=[self.books])
+        return super().setUp()
+
+    def test_fan_out_takes_the_slowest_venue(self):
+        start = time.monotonic()
+        quotes = self.runner.quote()
+        elapsed = time.monotonic() - start
+        self.assertEqual(set(quotes), {'fast', 'slow'})
+        self.assertEqual(set(quotes['fast']), set(self.books))
+        self.assertLess(elapsed, 0.2 + 0.1)
+
+    def test_cross_venue_route(self):
+        routes = self.runner.opportunities()
+        cross = [route for route in routes if route['type'] == 'cross_venue']
+        self.assertEqual(len(cross), 1)
+        self.assertEqual(cross[0]['route'], 'btc_mxn:fast->slow')
+        self.assertEqual([leg['venue'] for leg in cross[0]['legs']], ['fast', 'slow'])
+
+    def test_triangle_across_venues(self):
+        routes = self.runner.opportunities()
+        triangles = [route for route in routes if route['type'] == 'triangular']
+        self.assertEqual([route['route'] for route in triangles], ['eth_mxn-eth_btc-btc_mxn:bid'])
+        self.assertEqual(triangles[0]['legs'][2]['venue'], 'slow')
+
+    def test_fees_remove_opportunities(self):
+        self.fast.feeRatio = self.slow.feeRatio = 0.01
+        self.assertEqual(self.runner.opportunities(), [])
+
+    def test_venue_down_is_skipped(self):
+        self.slow.down = True
+        quotes = self.runner.quote()
+        self.assertEqual(set(quotes), {'fast'})
+        self.assertEqual(self.runner.evaluate(quotes)[0]['type'], 'triangular')
+
+    def test_timeout_drops_slow_venue(self):
+        self.runner.timeout = 0.1
+        self.assertEqual(set(self.runner.quote()), {'fast'})
+
+    def test_interface_is_enforced(self):
+        class Partial(ExchangeEngineBase):
+            def __init__(self):
+                pass
+
+            def get_order_book_innermost(self, book):
+                pass
+
+        with self.assertRaises(TypeError):
+            Partial()
+
+    def test_mock_venue_orders(self):
+        venue = MockVenue('mock', {'btc_mxn': _quote(100, 101)}, balances={'mxn': 10.0, 'btc': 1.0})
+        placed = venue.map([venue.place_order({'book': 'btc_mxn', 'side': 'buy', 'major': 1, 'price': 100})])
+        oid = placed[0].parsed['oid']
+        balance, depth, open_orders = venue.map([
+            venue.get_balance(tickers=['mxn']), venue.get_order_book_depth('btc_mxn'), venue.list_open_orders(),
+        ])
+        self.assertEqual(balance.parsed, {'mxn': 10.0})
+        self.assertEqual(depth.parsed['asks'], [(101, 1.0)])
+        self.assertEqual([order['oid'] for order in open_orders.parsed], [oid])
+        self.assertEqual(venue.map([venue.cancel_order(oid)])[0].parsed, [oid])
+        self.assertEqual(venue.orders, {})
+        venue.map([venue.get_order_book_innermost('btc_mxn')])
+        self.assertEqual(venue.history.get('btc_mxn')[-1][1], 100)
+
+    def test_fees_prefetched_with_quotes(self):
+        venue = _FeeVenue('fees', self.fast.quotes, fee=0.01)
+        self.runner.engines = {'fees': venue, 'slow': self.slow}
+        self.runner.last_quotes = {'fees': {}, 'slow': {}}
+        self.assertEqual(venue.taker_fee('btc_mxn'), 0.01)
+        self.runner.quote()
+        self.runner.quote()
+        self.assertEqual(venue.fee_fetches, 1)
+        self.assertEqual(venue.taker_fee('btc_mxn'), 0.002)
+
+    def test_scheduler_limits_polls_and_keeps_last_quotes(self):
+        now = [0]
+        scheduler = PollScheduler(self.fast, self.books, requests_per_minute=6, burst=3,
+                                  clock=lambda: now[0])
+        self.runner.schedulers = {'fast': scheduler}
+        rounds = list(self.runner.run(tick=0, rounds=2))
+        # the first round spends the burst, the second has nothing due
+        self.assertEqual(self.fast.requests, 3)
+        self.assertEqual(self.slow.requests, 6)
+        self.assertEqual(rounds[0], rounds[1])
+        self.assertIn(tuple(self.books), scheduler.proximity)
+        self.assertEqual(scheduler.proximity[tuple(self.books)], 1)
+
+    def test_stale_last_quotes_dropped(self):
+        now = [0]
+        scheduler = PollScheduler(self.fast, self.books, requests_per_minute=6, burst=3,
+                                  max_interval=30, clock=lambda: now[0])
+        self.runner.schedulers = {'fast': scheduler}
+        self.assertEqual(set(self.runner.quote()['fast']), set(self.books))
+        # the venue stops answering and the kept quotes age out
+        self.fast.down = True
+        now[0] = 31
+        self.assertNotIn('fast', self.runner.quote())
+        self.assertEqual(self.runner.last_quotes['fast'], {})
+
+
+if __name__ == '__main__':
+    unittest.main()
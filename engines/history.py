@@ -0,0 +1,180 @@
+import time
+import unittest
+import numpy as np
+
+TIME, BID, ASK, LAST = range(4)
+
+
+class RingBuffer(object):
+    """
+    Fixed size float64 buffer of rows. Appends overwrite the oldest row once
+    full, so memory stays flat no matter how long the bot runs.
+    """
+
+    def __init__(self, capacity, columns):
+        self.capacity = capacity
+        self.data = np.full((capacity, columns), np.nan)
+        self.index = 0
+        self.count = 0
+
+    def append(self, row):
+        self.data[self.index] = row
+        self.index = (self.index + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def last(self, n=None):
+        """Most recent n rows (all if None) in chronological order."""
+        n = self.count if n is None else min(n, self.count)
+        start = (self.index - n) % self.capacity
+        if start + n <= self.capacity:
+            # a copy, so later appends don't change rows the caller holds
+            return self.data[start:start + n].copy()
+        return np.concatenate((self.data[start:], self.data[:self.index]))
+
+    def __len__(self):
+        return self.count
+
+
+def _log_returns(prices):
+    prices = prices[~np.isnan(prices)]
+    if len(prices) < 2:
+        return np.empty(0)
+    return np.diff(np.log(prices))
+
+
+class TickerHistory(object):
+    """
+    Rolling per book history of (time, bid, ask, last) plus the triangular
+    route values, with vectorized statistics over the most recent samples.
+    """
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.books = {}
+        self.routes = {}
+
+    def _buffer(self, store, key, columns):
+        if key not in store:
+            store[key] = RingBuffer(self.capacity, columns)
+        return store[key]
+
+    def append(self, book, bid=np.nan, ask=np.nan, last=np.nan, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        self._buffer(self.books, book, 4).append((timestamp, bid, ask, last))
+
+    def append_route(self, name, value, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        self._buffer(self.routes, name, 2).append((timestamp, value))
+
+    def get(self, book, window=None):
+        if book not in self.books:
+            return np.empty((0, 4))
+        return self.books[book].last(window)
+
+    def mid(self, book, window=None):
+        """
+        Mid prices of the book snapshots in the window, or the last traded
+        prices when there are none. The two are never mixed: last price rows
+        sit between book rows and would make the series jump every sample.
+        """
+        rows = self.get(book, window)
+        mid = (rows[:, BID] + rows[:, ASK]) / 2
+        quoted = ~np.isnan(mid)
+        if quoted.any():
+            return mid[quoted]
+        return rows[:, LAST]
+
+    def spread(self, book, window=None):
+        """Mean relative bid/ask spread."""
+        rows = self.get(book, window)
+        spreads = (rows[:, ASK] - rows[:, BID]) / ((rows[:, ASK] + rows[:, BID]) / 2)
+        spreads = spreads[~np.isnan(spreads)]
+        return float(spreads.mean()) if len(spreads) else np.nan
+
+    def volatility(self, book, window=None):
+        """Standard deviation of log returns of the mid price."""
+        returns = _log_returns(self.mid(book, window))
+        return float(returns.std()) if len(returns) > 1 else np.nan
+
+    def route_ewma(self, name, span=20, window=None):
+        """Exponentially weighted mean of a route value, newest weighted most."""
+        if name not in self.routes:
+            return np.nan
+        values = self.routes[name].last(window)[:, 1]
+        if not len(values):
+            return np.nan
+        alpha = 2 / (span + 1)
+        weights = (1 - alpha) ** np.arange(len(values) - 1, -1, -1)
+        return float(np.dot(weights, values) / weights.sum())
+
+    def correlation(self, books, window=None):
+        """Correlation matrix of mid price log returns across books."""
+        returns = [np.diff(np.log(self.mid(book, window))) for book in books]
+        n = min(len(r) for r in returns)
+        if n < 2:
+            return np.full((len(books), len(books)), np.nan)
+        matrix = np.vstack([r[-n:] for r in returns])
+        mask = ~np.isnan(matrix).any(axis=0)
+        return np.corrcoef(matrix[:, mask])
+
+
+class TestTickerHistory(unittest.TestCase):
+
+    def test_ring_buffer_wraps(self):
+        buffer = RingBuffer(3, 1)
+        for i in range(5):
+            buffer.append((i,))
+        self.assertEqual(len(buffer), 3)
+        self.assertEqual(buffer.last()[:, 0].tolist(), [2, 3, 4])
+        self.assertEqual(buffer.last(2)[:, 0].tolist(), [3, 4])
+
+    def test_last_is_a_copy(self):
+        buffer = RingBuffer(3, 1)
+        buffer.append((1,))
+        rows = buffer.last()
+        buffer.append((2,))
+        buffer.data[0] = 5
+        self.assertEqual(rows[:, 0].tolist(), [1])
+
+    def test_last_price_rows_do_not_move_mid(self):
+        history = TickerHistory()
+        for i in range(10):
+            history.append('eth_mxn', bid=99, ask=101, timestamp=i)
+            history.append('eth_mxn', last=100.5 + i % 2, timestamp=i)
+        self.assertEqual(history.mid('eth_mxn').tolist(), [100] * 10)
+        self.assertAlmostEqual(history.volatility('eth_mxn'), 0)
+
+    def test_memory_is_flat(self):
+        history = TickerHistory(capacity=10)
+        for i in range(1000):
+            history.append('btc_mxn', bid=100 + i, ask=101 + i, timestamp=i)
+        self.assertEqual(history.books['btc_mxn'].data.shape, (10, 4))
+        self.assertEqual(history.get('btc_mxn')[-1, BID], 1099)
+
+    def test_spread_and_volatility(self):
+        history = TickerHistory()
+        for i in range(10):
+            history.append('eth_mxn', bid=99, ask=101, timestamp=i)
+        self.assertAlmostEqual(history.spread('eth_mxn'), 0.02)
+        self.assertAlmostEqual(history.volatility('eth_mxn'), 0)
+
+    def test_route_ewma_weights_newest(self):
+        history = TickerHistory()
+        for value in [1.0] * 10 + [2.0]:
+            history.append_route('bid', value)
+        ewma = history.route_ewma('bid', span=3)
+        self.assertGreater(ewma, 1.4)
+        self.assertLess(ewma, 2.0)
+
+    def test_correlation(self):
+        history = TickerHistory()
+        prices = [100, 101, 99, 102, 103, 101]
+        for i, price in enumerate(prices):
+            history.append('a', last=price, timestamp=i)
+            history.append('b', last=price * 2, timestamp=i)
+        corr = history.correlation(['a', 'b'])
+        self.assertAlmostEqual(corr[0, 1], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,266 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS opportunities (
+    ts REAL NOT NULL,
+    route TEXT NOT NULL,
+    value REAL NOT NULL,
+    threshold REAL NOT NULL,
+    status TEXT NOT NULL,
+    books TEXT,
+    orders TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_opportunities_ts ON opportunities (ts);
+CREATE INDEX IF NOT EXISTS idx_opportunities_route_ts ON opportunities (route, ts);
+
+CREATE TABLE IF NOT EXISTS orders (
+    ts REAL NOT NULL,
+    route TEXT,
+    book TEXT NOT NULL,
+    side TEXT NOT NULL,
+    price REAL,
+    amount REAL,
+    oid TEXT,
+    response TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_orders_ts ON orders (ts);
+CREATE INDEX IF NOT EXISTS idx_orders_book_ts ON orders (book, ts);
+CREATE INDEX IF NOT EXISTS idx_orders_oid ON orders (oid);
+
+CREATE TABLE IF NOT EXISTS fills (
+    ts REAL NOT NULL,
+    oid TEXT,
+    book TEXT NOT NULL,
+    side TEXT NOT NULL,
+    price REAL NOT NULL,
+    amount REAL NOT NULL,
+    fee REAL
+);
+CREATE INDEX IF NOT EXISTS idx_fills_ts ON fills (ts);
+CREATE INDEX IF NOT EXISTS idx_fills_book_ts ON fills (book, ts);
+
+CREATE TABLE IF NOT EXISTS balances (
+    ts REAL NOT NULL,
+    currency TEXT NOT NULL,
+    amount REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_balances_currency_ts ON balances (currency, ts);
+"""
+
+INSERTS = {
+    'opportunities': 'INSERT INTO opportunities VALUES (?, ?, ?, ?, ?, ?, ?)',
+    'orders': 'INSERT INTO orders VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+    'fills': 'INSERT INTO fills VALUES (?, ?, ?, ?, ?, ?, ?)',
+    'balances': 'INSERT INTO balances VALUES (?, ?, ?)',
+}
+
+
+class Journal(object):
+    """
+    SQLite (WAL) record of opportunities, orders, fills and balances.
+
+    The record_* methods only put rows on a queue, a background thread owns
+    the connection and writes them in batches so the trading loop never
+    waits on disk.
+    """
+
+    def __init__(self, path, batch_size=500, flush_interval=1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self._closed = False
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        conn.close()
+        self.thread = threading.Thread(target=self._writer, name='journal', daemon=True)
+        self.thread.start()
+        # drain whatever is still queued when the bot exits
+        atexit.register(self.close)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _writer(self):
+        conn = self._connect()
+        running = True
+        while running:
+            batch = []
+            try:
+                batch.append(self.queue.get(timeout=self.flush_interval))
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            rows = {}
+            events = []
+            for item in batch:
+                if item is None:
+                    running = False
+                elif isinstance(item, threading.Event):
+                    events.append(item)
+                else:
+                    table, row = item
+                    rows.setdefault(table, []).append(row)
+            if rows:
+                self._write(conn, rows)
+            for event in events:
+                event.set()
+        conn.close()
+
+    def _write(self, conn, rows):
+        try:
+            with conn:
+                for table, values in rows.items():
+                    conn.executemany(INSERTS[table], values)
+            return
+        except sqlite3.Error:
+            logger.exception('journal batch failed, writing its rows one by one')
+        # the batch was rolled back, keep every row but the bad ones
+        for table, values in rows.items():
+            for row in values:
+                try:
+                    with conn:
+                        conn.execute(INSERTS[table], row)
+                except sqlite3.Error as e:
+                    logger.error('journal dropped %s row %r: %s', table, row, e)
+
+    def _put(self, table, row):
+        if not self._closed:
+            self.queue.put((table, row))
+
+    def record_opportunity(self, route, value, threshold, status, books=None, orders=None, ts=None):
+        self._put('opportunities', (
+            time.time() if ts is None else ts, route, value, threshold, status,
+            json.dumps(books) if books is not None else None,
+            json.dumps(orders) if orders is not None else None,
+        ))
+
+    def record_order(self, order, result=None, route=None, ts=None):
+        """`result` is the engine's parsed place_order result, None when it failed."""
+        self._put('orders', (
+            time.time() if ts is None else ts, route, order['book'], order['side'],
+            order.get('price'), order.get('major'), result.get('oid') if result else None,
+            json.dumps(result) if result is not None else None,
+        ))
+
+    def record_fill(self, book, side, price, amount, oid=None, fee=None, ts=None):
+        self._put('fills', (time.time() if ts is None else ts, oid, book, side, price, amount, fee))
+
+    def record_balances(self, balances, ts=None):
+        ts = time.time() if ts is None else ts
+        for currency, amount in balances.items():
+            self._put('balances', (ts, currency, amount))
+
+    def flush(self, timeout=None):
+        """Block until everything queued so far is on disk."""
+        if self._closed or not self.thread.is_alive():
+            # close drains the queue, there is no writer left to wait for
+            self.thread.join(timeout)
+            return self._closed and not self.thread.is_alive()
+        event = threading.Event()
+        self.queue.put(event)
+        return event.wait(timeout)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self.queue.put(None)
+        self.thread.join()
+
+    def query(self, sql, params=()):
+        """Read only query on its own connection, safe alongside the writer."""
+        conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True)
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+    def opportunities(self, since=0, until=None, route=None, status=None):
+        sql = 'SELECT * FROM opportunities WHERE ts >= ? AND ts < ?'
+        params = [since, until or float('inf')]
+        if route:
+            sql += ' AND route = ?'
+            params.append(route)
+        if status:
+            sql += ' AND status = ?'
+            params.append(status)
+        return self.query(sql + ' ORDER BY ts', params)
+
+    def orders(self, since=0, until=None, book=None):
+        sql = 'SELECT * FROM orders WHERE ts >= ? AND ts < ?'
+        params = [since, until or float('inf')]
+        if book:
+            sql += ' AND book = ?'
+            params.append(book)
+        return self.query(sql + ' ORDER BY ts', params)
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        self.journal = Journal(os.path.join(self.dir.name, 'journal.db'), flush_interval=0.05)
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        self.journal.close()
+        self.dir.cleanup()
+        return super().tearDown()
+
+    def test_wal_mode(self):
+        self.assertEqual(self.journal.query('PRAGMA journal_mode')[0][0], 'wal')
+
+    def test_opportunities_by_route(self):
+        self.journal.record_opportunity('bid', 1.002, 1, 'amounts too low', ts=10)
+        self.journal.record_opportunity('ask', 1.001, 1, 'placed', ts=20)
+        self.assertTrue(self.journal.flush(timeout=5))
+        rows = self.journal.opportunities(route='bid')
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0][4], 'amounts too low')
+        self.assertEqual(len(self.journal.opportunities(since=15)), 1)
+
+    def test_orders_and_balances(self):
+        order = {'book': 'btc_mxn', 'side': 'buy', 'price': 100.0, 'major': 0.1}
+        self.journal.record_order(order, {'oid': 'abc'}, route='bid')
+        self.journal.record_balances({'mxn': 1000.0, 'btc': 0.5})
+        self.assertTrue(self.journal.flush(timeout=5))
+        self.assertEqual(self.journal.orders(book='btc_mxn')[0][6], 'abc')
+        self.assertEqual(self.journal.query('SELECT COUNT(*) FROM balances')[0][0], 2)
+
+    def test_bad_row_does_not_stop_writer(self):
+        self.journal.record_fill('eth_mxn', 'sell', float('nan'), 0.01, ts=1)
+        self.journal.record_fill('eth_mxn', 'sell', 100.0, 0.01, ts=2)
+        self.assertTrue(self.journal.flush(timeout=5))
+        self.journal.record_fill('eth_mxn', 'buy', 100.0, 0.01, ts=3)
+        self.assertTrue(self.journal.flush(timeout=5))
+        self.assertEqual(self.journal.query('SELECT ts FROM fills ORDER BY ts'), [(2.0,), (3.0,)])
+
+    def test_flush_after_close(self):
+        self.journal.close()
+        self.assertTrue(self.journal.flush())
+
+    def test_close_drains_queue(self):
+        for i in range(2000):
+            self.journal.record_fill('eth_mxn', 'sell', 100.0, 0.01, ts=i)
+        self.journal.close()
+        self.assertEqual(self.journal.query('SELECT COUNT(*) FROM fills')[0][0], 2000)
+
+
+if __name__ == '__main__':
+    unittest.main()
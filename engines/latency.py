@@ -0,0 +1,297 @@
+import time
+import unittest
+from collections import deque
+import gevent
+
+
+class LatencyTracker(object):
+    """
+    Keeps a bounded window of response times per endpoint so the hedging
+    delay can follow what each endpoint is actually doing.
+    """
+
+    def __init__(self, window=200, min_samples=20):
+        self.window = window
+        self.min_samples = min_samples
+        self.samples = {}
+
+    def record(self, endpoint, seconds):
+        if endpoint not in self.samples:
+            self.samples[endpoint] = deque(maxlen=self.window)
+        self.samples[endpoint].append(seconds)
+
+    def percentile(self, endpoint, q, default=None):
+        samples = self.samples.get(endpoint)
+        if not samples or len(samples) < self.min_samples:
+            return default
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))
+        return ordered[index]
+
+
+class CircuitBreaker(object):
+    """
+    Opens an endpoint after `threshold` consecutive failures. While open the
+    endpoint is skipped, after `cooldown` seconds a single trial request is
+    let through (half open) and its outcome closes or re-opens the circuit.
+    A trial that never reports back is given up after another `cooldown`,
+    so a lost request cannot keep the endpoint shut.
+    """
+
+    def __init__(self, threshold=5, cooldown=30, clock=time.monotonic):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.failures = {}
+        self.opened_at = {}
+        # endpoint -> when its half open trial was let through
+        self.trial = {}
+
+    def allow(self, endpoint):
+        opened_at = self.opened_at.get(endpoint)
+        if opened_at is None:
+            return True
+        now = self.clock()
+        started = self.trial.get(endpoint)
+        if started is not None and now - started < self.cooldown:
+            return False
+        if now - opened_at >= self.cooldown:
+            self.trial[endpoint] = now
+            return True
+        return False
+
+    def is_open(self, endpoint):
+        return endpoint in self.opened_at
+
+    def record_success(self, endpoint):
+        self.failures[endpoint] = 0
+        self.opened_at.pop(endpoint, None)
+        self.trial.pop(endpoint, None)
+
+    def record_failure(self, endpoint):
+        self.failures[endpoint] = self.failures.get(endpoint, 0) + 1
+        if endpoint in self.trial or self.failures[endpoint] >= self.threshold:
+            self.opened_at[endpoint] = self.clock()
+        self.trial.pop(endpoint, None)
+
+
+def _succeeded(req):
+    return req.response is not None and req.response.status_code < 500
+
+
+def _hedged_send(req, engine):
+    endpoint = getattr(req, 'endpoint', None)
+    # the breaker only gates idempotent reads, a half open circuit letting
+    # one order of a triangle through would leave the other legs unplaced
+    guarded = req.method == 'GET'
+    if guarded and not engine.breaker.allow(endpoint):
+        return None
+    # allowed through an open circuit means this is the half open trial
+    trial = guarded and engine.breaker.is_open(endpoint)
+    start = time.monotonic()
+    first = gevent.spawn(req.send)
+    spawned = [first]
+    try:
+        hedge_after = engine.hedge_delay(endpoint)
+        first.join(timeout=hedge_after)
+        winner = req
+        rebuild = getattr(req, 'rebuild', None)
+        if not first.ready() and req.method == 'GET' and rebuild is not None:
+            # only idempotent calls are duplicated; the clone is rebuilt
+            # through the engine and signs its own nonce when it is sent
+            clone = rebuild()
+            second = gevent.spawn(clone.send)
+            spawned.append(second)
+            pending = {first: req, second: clone}
+            winner = None
+            while pending:
+                done = gevent.wait(list(pending), count=1)[0]
+                candidate = pending.pop(done)
+                if _succeeded(candidate) or not pending:
+                    winner = candidate
+                    break
+            gevent.killall(list(pending), block=False)
+        else:
+            first.join()
+    except gevent.GreenletExit:
+        # a killed trial never reports back, count it as failed so the
+        # breaker can let the next one through after its cooldown
+        if trial:
+            engine.breaker.record_failure(endpoint)
+        raise
+    finally:
+        # killed from outside (e.g. a venue timing out in CrossVenueRunner),
+        # the sends must not finish later and touch history or the breaker
+        gevent.killall(spawned, block=False)
+    if _succeeded(winner):
+        engine.latency.record(endpoint, time.monotonic() - start)
+        if guarded:
+            engine.breaker.record_success(endpoint)
+        req.response = winner.response
+    else:
+        if guarded:
+            engine.breaker.record_failure(endpoint)
+        req.response = None
+    return req.response
+
+
+def hedged_map(requests, engine):
+    """
+    Like grequests.map but every request runs under the engine's timeouts,
+    GETs that exceed their endpoint p95 are hedged with a duplicate, and
+    endpoints with an open circuit are skipped. Failed entries are None.
+    """
+    jobs = [gevent.spawn(_hedged_send, req, engine) for req in requests]
+    try:
+        gevent.joinall(jobs)
+    finally:
+        # blocking, so a killed map has settled the breaker before it exits
+        gevent.killall(jobs)
+    return [job.value for job in jobs]
+
+
+class _FakeResponse(object):
+    status_code = 200
+
+
+class _FakeRequest(object):
+
+    def __init__(self, delays, method='GET'):
+        self.method = method
+        self.endpoint = 'order_book'
+        self.delays = delays
+        self.delay = delays.pop(0)
+        self.response = None
+        self.rebuild = lambda: _FakeRequest(self.delays, method)
+
+    def send(self):
+        gevent.sleep(self.delay)
+        self.response = _FakeResponse()
+        return self
+
+
+class _FakeEngine(object):
+
+    def __init__(self, delay):
+        self.latency = LatencyTracker()
+        self.breaker = CircuitBreaker(threshold=1, cooldown=60)
+        self.delay = delay
+
+    def hedge_delay(self, endpoint):
+        return self.delay
+
+
+class TestLatency(unittest.TestCase):
+
+    def test_slow_get_is_hedged(self):
+        engine = _FakeEngine(0.01)
+        req = _FakeRequest([5, 0.01])
+        start = time.monotonic()
+        responses = hedged_map([req], engine)
+        self.assertIsNotNone(responses[0])
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_post_is_not_hedged(self):
+        engine = _FakeEngine(0.01)
+        req = _FakeRequest([0.05, 0], method='POST')
+        hedged_map([req], engine)
+        self.assertEqual(req.delays, [0])
+
+    def test_open_circuit_does_not_gate_orders(self):
+        now = [0]
+        engine = _FakeEngine(0.01)
+        engine.breaker = CircuitBreaker(threshold=1, cooldown=10, clock=lambda: now[0])
+        engine.breaker.record_failure('order_book')
+        now[0] = 10
+        # past the cooldown only one GET may trial, every leg of a batch of orders goes out
+        orders = [_FakeRequest([0], method='POST') for _ in range(3)]
+        for req in orders:
+            req.endpoint = 'order_book'
+        self.assertTrue(all(res is not None for res in hedged_map(orders, engine)))
+        reads = [_FakeRequest([0]) for _ in range(3)]
+        self.assertEqual(sum(res is not None for res in hedged_map(reads, engine)), 1)
+
+    def test_killed_map_stops_its_sends(self):
+        engine = _FakeEngine(0.01)
+        req = _FakeRequest([0.2, 0.2])
+        job = gevent.spawn(hedged_map, [req], engine)
+        gevent.sleep(0.05)
+        job.kill(block=False)
+        gevent.sleep(0.3)
+        self.assertIsNone(req.response)
+        self.assertEqual(engine.latency.samples.get('order_book', []), [])
+        self.assertFalse(engine.breaker.is_open('order_book'))
+
+    def test_open_circuit_skips_request(self):
+        engine = _FakeEngine(0.01)
+        engine.breaker.record_failure('order_book')
+        req = _FakeRequest([0])
+        self.assertEqual(hedged_map([req], engine), [None])
+        self.assertIsNone(req.response)
+
+    def test_percentile_needs_min_samples(self):
+        tracker = LatencyTracker(window=10, min_samples=3)
+        tracker.record('ticker', 0.1)
+        self.assertIsNone(tracker.percentile('ticker', 0.95))
+        tracker.record('ticker', 0.2)
+        tracker.record('ticker', 0.3)
+        self.assertEqual(tracker.percentile('ticker', 0.95), 0.3)
+
+    def test_window_is_bounded(self):
+        tracker = LatencyTracker(window=5, min_samples=1)
+        for i in range(100):
+            tracker.record('order_book', i)
+        self.assertEqual(len(tracker.samples['order_book']), 5)
+        self.assertEqual(tracker.percentile('order_book', 0.0), 95)
+
+    def test_breaker_opens_and_half_opens(self):
+        now = [0]
+        breaker = CircuitBreaker(threshold=2, cooldown=10, clock=lambda: now[0])
+        breaker.record_failure('order_book')
+        self.assertTrue(breaker.allow('order_book'))
+        breaker.record_failure('order_book')
+        self.assertFalse(breaker.allow('order_book'))
+        now[0] = 10
+        self.assertTrue(breaker.allow('order_book'))
+        # only one trial request while half open
+        self.assertFalse(breaker.allow('order_book'))
+        breaker.record_success('order_book')
+        self.assertFalse(breaker.is_open('order_book'))
+        self.assertTrue(breaker.allow('order_book'))
+
+    def test_killed_trial_does_not_wedge_breaker(self):
+        now = [0]
+        engine = _FakeEngine(10)
+        engine.breaker = CircuitBreaker(threshold=1, cooldown=10, clock=lambda: now[0])
+        engine.breaker.record_failure('order_book')
+        now[0] = 10
+        job = gevent.spawn(hedged_map, [_FakeRequest([5])], engine)
+        gevent.sleep(0.01)
+        job.kill()
+        self.assertNotIn('order_book', engine.breaker.trial)
+        now[0] = 20
+        self.assertTrue(engine.breaker.allow('order_book'))
+
+    def test_lost_trial_expires(self):
+        now = [0]
+        breaker = CircuitBreaker(threshold=1, cooldown=10, clock=lambda: now[0])
+        breaker.record_failure('ticker')
+        now[0] = 10
+        self.assertTrue(breaker.allow('ticker'))
+        now[0] = 15
+        self.assertFalse(breaker.allow('ticker'))
+        now[0] = 20
+        self.assertTrue(breaker.allow('ticker'))
+
+    def test_failed_trial_reopens(self):
+        now = [0]
+        breaker = CircuitBreaker(threshold=1, cooldown=10, clock=lambda: now[0])
+        breaker.record_failure('ticker')
+        now[0] = 10
+        self.assertTrue(breaker.allow('ticker'))
+        breaker.record_failure('ticker')
+        self.assertFalse(breaker.allow('ticker'))
+
+
+if __name__ == '__main__':
+    unittest.main()
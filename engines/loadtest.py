@@ -0,0 +1,280 @@
+import argparse
+import gc
+import json
+import logging
+import random
+import resource
+import time
+import unittest
+import numpy as np
+from engines.history import TickerHistory
+from engines.triangular_arbitrage import CryptoEngineTriArbitrage
+
+
+class SyntheticMarket(object):
+    """
+    Random walk prices for every coin in mxn. Each book quotes the cross of
+    its two coins plus its own noise, so triangles drift in and out of
+    profitability the way real books do.
+    """
+
+    def __init__(self, coins, volatility=0.0005, noise=0.0008, spread=0.0005,
+                 levels=20, seed=None):
+        self.random = random.Random(seed)
+        self.prices = {coin: self.random.uniform(10, 1000) for coin in coins}
+        self.prices['mxn'] = 1.0
+        self.prices['btc'] = 700000.0
+        self.volatility = volatility
+        self.noise = noise
+        self.spread = spread
+        self.levels = levels
+
+    def step(self):
+        for coin in self.prices:
+            if coin != 'mxn':
+                self.prices[coin] *= 1 + self.random.gauss(0, self.volatility)
+
+    def depth(self, book):
+        base, quote = book.split('_')
+        mid = self.prices[base] / self.prices[quote] * (1 + self.random.gauss(0, self.noise))
+        half = mid * self.spread / 2
+        bids = [(mid - half * (1 + i), self.random.uniform(0.1, 2)) for i in range(self.levels)]
+        asks = [(mid + half * (1 + i), self.random.uniform(0.1, 2)) for i in range(self.levels)]
+        return bids, asks
+
+
+class _StubResponse(object):
+    status_code = 200
+
+    def __init__(self, parsed):
+        self.parsed = parsed
+
+    def json(self):
+        return {'success': True, 'payload': self.parsed}
+
+
+class _StubRequest(object):
+
+    def __init__(self, method, endpoint, build):
+        self.method = method
+        self.url = f'stub://{endpoint}'
+        self.endpoint = endpoint
+        self.build = build
+        self.response = None
+
+    def send(self, **kwargs):
+        self.response = _StubResponse(self.build())
+        return self
+
+
+class StubEngine(object):
+    """
+    In-process stand-in for ExchangeEngine that answers from a synthetic
+    market, with the time spent fetching accumulated in `fetch_time`.
+    """
+
+    def __init__(self, market, books, balance=10 ** 6):
+        self.market = market
+        self.books = books
+        self.balance = balance
+        self.history = TickerHistory()
+        self.fetch_time = 0.0
+
+    def map(self, requests):
+        start = time.perf_counter()
+        responses = [req.send().response for req in requests]
+        self.fetch_time += time.perf_counter() - start
+        return responses
+
+    def get_available_books(self, books=[]):
+        return _StubRequest('GET', 'available_books', lambda: {
+            book: {'minimum_amount': 0.0001, 'maximum_amount': 10 ** 6} for book in books
+        })
+
+    def get_order_book_innermost(self, book):
+        def build():
+            bids, asks = self.market.depth(book)
+            self.history.append(book, bid=bids[0][0], ask=asks[0][0])
+            return {
+                'book': book,
+                'bid': {'price': bids[0][0], 'amount': bids[0][1]},
+                'ask': {'price': asks[0][0], 'amount': asks[0][1]},
+            }
+        return _StubRequest('GET', 'order_book', build)
+
+    def get_order_book_depth(self, book, levels=20):
+        def build():
+            bids, asks = self.market.depth(book)
+            self.history.append(book, bid=bids[0][0], ask=asks[0][0])
+            return {'book': book, 'bids': bids[:levels], 'asks': asks[:levels]}
+        return _StubRequest('GET', 'order_book', build)
+
+    def list_fees(self, books=[]):
+        return _StubRequest('GET', 'fees', lambda: {
+            book: {'book': book, 'taker_fee': 0.0} for book in books
+        })
+
+    def get_balance(self, tickers=[]):
+        return _StubRequest('GET', 'balance', lambda: {
+            ticker.lower(): self.balance / self.market.prices[ticker.lower()] for ticker in tickers
+        })
+
+    def list_open_orders(self, book=None):
+        return _StubRequest('GET', 'open_orders', lambda: [])
+
+    def place_order(self, body):
+        return _StubRequest('POST', 'orders', lambda: {'oid': 'stub'})
+
+
+def _percentiles(samples):
+    if not samples:
+        return {'p50': None, 'p95': None, 'p99': None, 'max': None}
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+    return {'p50': p50 * 1000, 'p95': p95 * 1000, 'p99': p99 * 1000, 'max': max(samples) * 1000}
+
+
+def _rss_kib():
+    """
+    Current resident set size, None where /proc is missing. ru_maxrss is a
+    process wide peak, so every point of a curve after the first would only
+    show growth above the earlier peaks.
+    """
+    gc.collect()
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except OSError:
+        return None
+    return pages * resource.getpagesize() // 1024
+
+
+def run(triangles=1, rate=10.0, duration=10.0, allocator=False, seed=0):
+    """
+    Tick every strategy `rate` times per second for `duration` seconds and
+    report throughput, lag behind the tick schedule, per stage latency
+    percentiles (ms) and memory growth.
+    """
+    rss_start = _rss_kib()
+    coins = [f'c{i}' for i in range(triangles)]
+    market = SyntheticMarket(coins, seed=seed)
+    strategies = []
+    for coin in coins:
+        books = [f'{coin}_mxn', f'{coin}_btc', 'btc_mxn']
+        config = {
+            'tickerPairA': books[0], 'tickerPairB': books[1], 'tickerPairC': books[2],
+            'tickerA': 'mxn', 'tickerB': coin, 'tickerC': 'btc',
+            'useAllocator': allocator,
+        }
+        strategy = CryptoEngineTriArbitrage(config, StubEngine(market, books))
+        strategy.mock = True
+        strategies.append(strategy)
+
+    stages = {'fetch': [], 'evaluate': [], 'tick': []}
+    lags = []
+    opportunities = 0
+    start = time.perf_counter()
+    ticks = 0
+    while True:
+        scheduled = start + ticks / rate
+        now = time.perf_counter()
+        if scheduled - start >= duration:
+            break
+        if now < scheduled:
+            time.sleep(scheduled - now)
+            now = time.perf_counter()
+        lags.append(now - scheduled)
+        market.step()
+        tick_start = time.perf_counter()
+        for strategy in strategies:
+            strategy.engine.fetch_time = 0.0
+            check_start = time.perf_counter()
+            if allocator:
+                found = strategy.check_order_book_allocated()
+            else:
+                found = strategy.check_order_book()
+            elapsed = time.perf_counter() - check_start
+            stages['fetch'].append(strategy.engine.fetch_time)
+            stages['evaluate'].append(elapsed - strategy.engine.fetch_time)
+            opportunities += bool(found)
+        stages['tick'].append(time.perf_counter() - tick_start)
+        ticks += 1
+    # the last tick's slot counts as elapsed even if it finished early
+    elapsed = max(time.perf_counter() - start, ticks / rate)
+    rss_end = _rss_kib()
+    return {
+        'triangles': triangles,
+        'books': 2 * triangles + 1,
+        'target_rate': rate,
+        'ticks': ticks,
+        'throughput': ticks / elapsed,
+        'evaluations_per_second': ticks * triangles / elapsed,
+        'opportunities': opportunities,
+        'lag_ms': _percentiles(lags),
+        'stages_ms': {stage: _percentiles(samples) for stage, samples in stages.items()},
+        'rss_growth_kib': None if rss_start is None else rss_end - rss_start,
+    }
+
+
+def scaling_curve(triangle_counts, rate, duration, allocator=False):
+    return [run(n, rate, duration, allocator) for n in triangle_counts]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the triangular arbitrage loop with synthetic books.")
+    parser.add_argument('--triangles', type=int, nargs='+', default=[1, 5, 10, 25, 50])
+    parser.add_argument('--rate', type=float, default=10, help="Ticks per second")
+    parser.add_argument('--duration', type=float, default=10, help="Seconds per point of the curve")
+    parser.add_argument('--allocator', action='store_true', help="Use check_order_book_allocated")
+    parser.add_argument('--log', action='store_true', help="Keep the strategy's per tick logging on")
+    parser.add_argument('--json', help="Write the curve to this file")
+    args = parser.parse_args()
+
+    if not args.log:
+        logging.getLogger('engines.triangular_arbitrage').setLevel(logging.WARNING)
+    curve = scaling_curve(args.triangles, args.rate, args.duration, args.allocator)
+    print(f"{'triangles':>9} {'books':>5} {'ticks/s':>8} {'lag p99':>9} {'tick p50':>9} "
+          f"{'tick p99':>9} {'fetch p99':>9} {'eval p99':>9} {'rss +KiB':>9}")
+    for point in curve:
+        stages = point['stages_ms']
+        print(f"{point['triangles']:>9} {point['books']:>5} {point['throughput']:>8.1f} "
+              f"{point['lag_ms']['p99']:>9.2f} {stages['tick']['p50']:>9.2f} {stages['tick']['p99']:>9.2f} "
+              f"{stages['fetch']['p99']:>9.3f} {stages['evaluate']['p99']:>9.3f} {point['rss_growth_kib'] if point['rss_growth_kib'] is not None else '-':>9}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(curve, f, indent=2)
+
+
+class TestLoadTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        logging.getLogger('engines.triangular_arbitrage').setLevel(logging.WARNING)
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        logging.getLogger('engines.triangular_arbitrage').setLevel(logging.DEBUG)
+        return super().tearDown()
+
+    def test_report(self):
+        report = run(triangles=2, rate=50, duration=0.2)
+        self.assertGreater(report['ticks'], 0)
+        self.assertEqual(report['books'], 5)
+        self.assertEqual(len(report['stages_ms']['tick']), 4)
+        self.assertIsNotNone(report['lag_ms']['p99'])
+
+    def test_allocator_path(self):
+        report = run(triangles=1, rate=50, duration=0.2, allocator=True)
+        self.assertGreater(report['ticks'], 0)
+
+    def test_rss_is_current_not_peak(self):
+        before = _rss_kib()
+        if before is None:
+            self.skipTest("no /proc/self/statm")
+        block = np.ones(64 * 1024 * 1024, dtype=np.uint8)
+        during = _rss_kib()
+        del block
+        self.assertGreater(during - before, 32 * 1024)
+        self.assertLess(_rss_kib(), during - 32 * 1024)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import unittest
+from collections import Counter
+from datetime import datetime
+
+
+class SamplingProfiler(object):
+    """
+    Low overhead wall clock profiler for a live process. A background thread
+    samples the target thread's stack every `interval` seconds and counts
+    identical stacks, which dump() writes in folded format
+    (`frame;frame;frame count`), the input flamegraph.pl and speedscope take.
+
+    With gevent all greenlets share the main thread, so each sample is the
+    stack of whichever greenlet was running, or the hub when idle.
+    """
+
+    def __init__(self, interval=0.005, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id or threading.main_thread().ident
+        self.stacks = Counter()
+        self.samples = 0
+        self._running = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._running.is_set()
+
+    def start(self):
+        if self.running:
+            return
+        self.stacks.clear()
+        self.samples = 0
+        self._running.set()
+        self._thread = threading.Thread(target=self._sample, name='profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running.clear()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _sample(self):
+        while self._running.is_set():
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+                self.samples += 1
+            time.sleep(self.interval)
+
+    def folded(self):
+        return '\n'.join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+    def dump(self, filename):
+        with open(filename, 'w') as f:
+            f.write(self.folded() + '\n')
+        return filename
+
+
+class AllocationTracker(object):
+    """Top allocations of a tracemalloc snapshot, grouped by line."""
+
+    def __init__(self, frames=10, top=25):
+        self.frames = frames
+        self.top = top
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+
+    def stop(self):
+        tracemalloc.stop()
+
+    def report(self):
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ])
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f"traced: {current / 1024:.1f} KiB, peak: {peak / 1024:.1f} KiB", "", "Top allocations:"]
+        lines += [str(stat) for stat in snapshot.statistics('lineno')[:self.top]]
+        return '\n'.join(lines)
+
+
+class ProfilingControl(object):
+    """
+    Signal driven profiling for the running bot:
+
+        kill -USR1 <pid>   start the sampling profiler, send again to stop it
+                           and write profile-<time>.folded
+        kill -USR2 <pid>   start tracemalloc, send again to stop it and write
+                           the top allocations to malloc-<time>.txt
+    """
+
+    def __init__(self, output_dir='.', interval=0.005, top=25, logger=None):
+        self.output_dir = output_dir
+        self.profiler = SamplingProfiler(interval=interval)
+        self.allocations = AllocationTracker(top=top)
+        self.logger = logger
+
+    def _log(self, msg):
+        if self.logger:
+            self.logger.info(msg)
+
+    def _filename(self, prefix, ext):
+        return os.path.join(self.output_dir, f"{prefix}-{datetime.now():%Y%m%d-%H%M%S}.{ext}")
+
+    def toggle_profiler(self, *args):
+        if not self.profiler.running:
+            self.profiler.start()
+            self._log("Profiler started")
+            return None
+        self.profiler.stop()
+        filename = self.profiler.dump(self._filename('profile', 'folded'))
+        self._log(f"Profiler stopped, {self.profiler.samples} samples written to {filename}")
+        return filename
+
+    def toggle_allocations(self, *args):
+        if not tracemalloc.is_tracing():
+            self.allocations.start()
+            self._log("tracemalloc started")
+            return None
+        filename = self._filename('malloc', 'txt')
+        with open(filename, 'w') as f:
+            f.write(self.allocations.report() + '\n')
+        # tracing slows every allocation down, don't leave it on in the live bot
+        self.allocations.stop()
+        self._log(f"tracemalloc stopped, report written to {filename}")
+        return filename
+
+    def install(self):
+        signal.signal(signal.SIGUSR1, self.toggle_profiler)
+        signal.signal(signal.SIGUSR2, self.toggle_allocations)
+        self._log(f"Profiling signals installed, pid {os.getpid()}")
+
+
+def _busy(seconds):
+    end = time.monotonic() + seconds
+    total = 0
+    while time.monotonic() < end:
+        total += 1
+    return total
+
+
+class TestProfiling(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.dir.cleanup()
+        return super().tearDown()
+
+    def test_folded_stacks(self):
+        profiler = SamplingProfiler(interval=0.001, thread_id=threading.get_ident())
+        profiler.start()
+        _busy(0.2)
+        profiler.stop()
+        self.assertGreater(profiler.samples, 0)
+        self.assertIn('profiling.py:_busy', profiler.folded())
+        for line in profiler.folded().splitlines():
+            stack, count = line.rsplit(' ', 1)
+            self.assertTrue(count.isdigit())
+
+    def test_signal_toggles(self):
+        control = ProfilingControl(output_dir=self.dir.name, interval=0.001)
+        control.install()
+        os.kill(os.getpid(), signal.SIGUSR1)
+        _busy(0.1)
+        os.kill(os.getpid(), signal.SIGUSR1)
+        os.kill(os.getpid(), signal.SIGUSR2)
+        self.assertTrue(tracemalloc.is_tracing())
+        data = [bytearray(1024) for _ in range(100)]
+        os.kill(os.getpid(), signal.SIGUSR2)
+        self.assertFalse(tracemalloc.is_tracing())
+        files = sorted(os.listdir(self.dir.name))
+        self.assertTrue(any(f.endswith('.folded') for f in files))
+        self.assertTrue(any(f.endswith('.txt') for f in files))
+        signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+        signal.signal(signal.SIGUSR2, signal.SIG_DFL)
+        self.assertEqual(len(data), 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
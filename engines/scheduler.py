@@ -0,0 +1,215 @@
+import math
+import time
+import unittest
+import gevent
+import numpy as np
+from engines.history import TickerHistory
+
+
+class TokenBucket(object):
+    """Request budget refilled at `rate` per second up to `capacity`."""
+
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.updated = clock()
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def take(self, n=1):
+        self.refill()
+        if self.tokens >= n:
+            self.tokens -= n
+            return True
+        return False
+
+    def give(self, n=1):
+        """Return tokens taken for requests that were never made."""
+        self.tokens = min(self.capacity, self.tokens + n)
+
+
+class PollScheduler(object):
+    """
+    Decides which books to poll next when following more books than the
+    rate limit allows polling every tick.
+
+    Each book gets a score from its recent mid price volatility and how close
+    the best triangle it belongs to is to the profitability threshold. The
+    sustainable request rate is split across books in proportion to their
+    score. The rate split is the refill rate plus the tokens left in the
+    bucket spread over `budget_horizon` seconds, so polling speeds up while
+    there is budget to spare and falls back to the sustainable rate as it
+    runs out. When the bucket runs low the most overdue high-score books
+    are served first.
+    """
+
+    def __init__(self, engine, books, requests_per_minute=60, burst=10,
+                 min_interval=1, max_interval=60, history_window=120,
+                 floor=0.1, volatility_weight=1.0, proximity_weight=2.0,
+                 proximity_scale=0.002, budget_horizon=60, clock=time.monotonic):
+        self.engine = engine
+        self.books = list(books)
+        self.bucket = TokenBucket(requests_per_minute / 60, burst, clock)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.history_window = history_window
+        self.floor = floor
+        self.volatility_weight = volatility_weight
+        self.proximity_weight = proximity_weight
+        self.proximity_scale = proximity_scale
+        self.budget_horizon = budget_horizon
+        self.clock = clock
+        self.last_poll = {book: None for book in self.books}
+        self.proximity = {}
+
+    def update_route(self, triangle, value, threshold):
+        """
+        Feed a route value for a triangle (tuple of books). Proximity is 1 at
+        or above the threshold and decays exponentially with the gap below it.
+        """
+        gap = max(threshold - value, 0)
+        self.proximity[tuple(triangle)] = math.exp(-gap / self.proximity_scale)
+
+    def scores(self):
+        history = getattr(self.engine, 'history', None) or TickerHistory()
+        volatility = np.array([history.volatility(book, self.history_window) for book in self.books])
+        volatility = np.nan_to_num(volatility)
+        if volatility.max() > 0:
+            volatility = volatility / volatility.max()
+        proximity = np.array([
+            max([p for triangle, p in self.proximity.items() if book in triangle], default=0)
+            for book in self.books
+        ])
+        return self.floor + self.volatility_weight * volatility + self.proximity_weight * proximity
+
+    def budget(self):
+        """Requests per second to spread over the books right now."""
+        return self.bucket.rate + self.bucket.refill() / self.budget_horizon
+
+    def intervals(self):
+        scores = self.scores()
+        rates = self.budget() * scores / scores.sum()
+        intervals = np.clip(1 / rates, self.min_interval, self.max_interval)
+        return dict(zip(self.books, intervals.tolist()))
+
+    def due(self):
+        """Books to poll now, highest priority first, within the request budget."""
+        now = self.clock()
+        intervals = self.intervals()
+        overdue = []
+        for book in self.books:
+            last = self.last_poll[book]
+            if last is None:
+                overdue.append((math.inf, book))
+                continue
+            lateness = (now - last) / intervals[book]
+            if lateness >= 1:
+                overdue.append((lateness, book))
+        overdue.sort(reverse=True)
+        books = []
+        for _, book in overdue:
+            if not self.bucket.take():
+                break
+            books.append(book)
+            self.last_poll[book] = now
+        return books
+
+    def poll(self):
+        """Poll the due books, returns {book: innermost book} for the ones that answered."""
+        previous = dict(self.last_poll)
+        books = self.due()
+        if not books:
+            return {}
+        try:
+            responses = self.engine.map([self.engine.get_order_book_innermost(book=book) for book in books])
+        except gevent.GreenletExit:
+            # killed before the answers came back (e.g. a fan out timeout),
+            # they are thrown away, so the books stay due and the budget is kept
+            self.bucket.give(len(books))
+            for book in books:
+                self.last_poll[book] = previous[book]
+            raise
+        return {book: res.parsed for book, res in zip(books, responses) if res is not None}
+
+
+class _Clock(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class _HistoryEngine(object):
+
+    def __init__(self):
+        self.history = TickerHistory()
+
+    def get_order_book_innermost(self, book):
+        return book
+
+    def map(self, requests):
+        gevent.sleep(1)
+
+
+class TestPollScheduler(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.clock = _Clock()
+        self.engine = _HistoryEngine()
+        self.books = ['btc_mxn', 'eth_mxn', 'eth_btc', 'xrp_mxn']
+        self.scheduler = PollScheduler(self.engine, self.books, requests_per_minute=60,
+                                       burst=4, max_interval=1000, clock=self.clock)
+        return super().setUp()
+
+    def test_first_round_polls_everything(self):
+        self.assertEqual(sorted(self.scheduler.due()), sorted(self.books))
+        self.assertEqual(self.scheduler.due(), [])
+
+    def test_killed_poll_keeps_budget_and_books_due(self):
+        job = gevent.spawn(self.scheduler.poll)
+        gevent.sleep(0)
+        self.assertEqual(self.scheduler.bucket.tokens, 0)
+        job.kill()
+        self.assertEqual(self.scheduler.bucket.tokens, 4)
+        self.assertEqual(sorted(self.scheduler.due()), sorted(self.books))
+
+    def test_budget_limits_polls(self):
+        self.scheduler.bucket.tokens = 2
+        self.assertEqual(len(self.scheduler.due()), 2)
+
+    def test_volatile_book_polled_more_often(self):
+        for i in range(50):
+            self.engine.history.append('btc_mxn', last=100 + (i % 2) * 5, timestamp=i)
+            self.engine.history.append('xrp_mxn', last=100, timestamp=i)
+        intervals = self.scheduler.intervals()
+        self.assertLess(intervals['btc_mxn'], intervals['xrp_mxn'])
+
+    def test_near_threshold_triangle_polled_more_often(self):
+        self.scheduler.update_route(('eth_mxn', 'eth_btc', 'btc_mxn'), 0.9995, 1)
+        intervals = self.scheduler.intervals()
+        self.assertLess(intervals['eth_btc'], intervals['xrp_mxn'])
+
+    def test_rates_stay_within_budget(self):
+        self.scheduler.update_route(('eth_mxn', 'eth_btc', 'btc_mxn'), 1.001, 1)
+        intervals = self.scheduler.intervals()
+        self.assertLessEqual(sum(1 / i for i in intervals.values()), self.scheduler.budget() + 1e-9)
+
+    def test_low_budget_slows_polling(self):
+        full = self.scheduler.intervals()
+        self.scheduler.bucket.tokens = 0
+        drained = self.scheduler.intervals()
+        for book in self.books:
+            self.assertGreater(drained[book], full[book])
+        self.assertLessEqual(sum(1 / i for i in drained.values()), self.scheduler.bucket.rate + 1e-9)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,273 @@
+import fcntl
+import hashlib
+import hmac
+import mmap
+import multiprocessing
+import os
+import struct
+import tempfile
+import threading
+import time
+import unittest
+from requests import Request, Session
+from requests.adapters import BaseAdapter
+from requests.auth import AuthBase
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+
+_NONCE = struct.Struct('<Q')
+
+
+class NonceAllocator(object):
+    """
+    Strictly increasing microsecond nonces.
+
+    Every nonce is max(now, last + 1), so bursts in the same microsecond and
+    clock steps backwards still move forward. Threads (and greenlets) share
+    `last` under a lock. Give a `path` to share it across processes as well:
+    the last nonce lives in an 8 byte mmapped file and each allocation is a
+    read-modify-write under flock, with no reopening or seeking per call.
+    Allocation order is not arrival order, so concurrent requests can still
+    reach Bitso out of order; BitsoAuth signs at send time and re-signs the
+    ones Bitso rejects for it.
+    """
+
+    def __init__(self, path=None, clock=time.time):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.last = 0
+        self.path = path
+        self.fd = None
+        self.map = None
+        if path:
+            self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            if os.fstat(self.fd).st_size < _NONCE.size:
+                os.ftruncate(self.fd, _NONCE.size)
+            self.map = mmap.mmap(self.fd, _NONCE.size)
+
+    def next(self):
+        now = int(self.clock() * 1000000)
+        with self.lock:
+            if self.map is None:
+                self.last = max(now, self.last + 1)
+                return self.last
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                last = _NONCE.unpack_from(self.map)[0]
+                nonce = max(now, last + 1)
+                _NONCE.pack_into(self.map, 0, nonce)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+            self.last = nonce
+            return nonce
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            os.close(self.fd)
+            self.map = None
+            self.fd = None
+
+
+class Signer(object):
+    """
+    Bitso HMAC-SHA256 request signing with the per key work done once: the
+    keyed hmac state is built up front and copied per request, and the
+    `Bitso <public>:` header prefix is pre-encoded.
+    """
+
+    def __init__(self, key, nonces=None):
+        self.nonces = nonces or NonceAllocator()
+        self.hmac = hmac.new(key['private'].encode('utf-8'), digestmod=hashlib.sha256)
+        self.prefix = f"Bitso {key['public']}:"
+
+    def sign(self, method, path, body=b''):
+        """`path` includes the query string, `body` is the exact bytes sent."""
+        nonce = str(self.nonces.next())
+        mac = self.hmac.copy()
+        mac.update(f"{nonce}{method}{path}".encode('utf-8'))
+        if body:
+            mac.update(body)
+        return f"{self.prefix}{nonce}:{mac.hexdigest()}"
+
+
+# Bitso's error code for a nonce that is not above the last one it accepted
+NONCE_ERROR_CODES = {'0201'}
+
+
+def _nonce_rejected(response):
+    if response.status_code < 400:
+        return False
+    try:
+        error = response.json().get('error') or {}
+    except ValueError:
+        return False
+    return error.get('code') in NONCE_ERROR_CODES or 'nonce' in str(error.get('message', '')).lower()
+
+
+class BitsoAuth(AuthBase):
+    """
+    requests auth that signs a request while it is being sent, not when it
+    is built, so the nonce is allocated as late as possible: method, path and
+    query, and body are taken from the prepared request, exactly as they go
+    on the wire. Concurrent requests can still overtake each other on their
+    way to Bitso; one rejected for its nonce was not executed, so it is
+    re-signed with a fresh nonce and resent, up to `retries` times.
+    """
+
+    def __init__(self, signer, retries=3):
+        self.signer = signer
+        self.retries = retries
+
+    def sign(self, request):
+        body = request.body or b''
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        request.headers['Authorization'] = self.signer.sign(request.method, request.path_url, body)
+
+    def handle_response(self, response, **kwargs):
+        for _ in range(self.retries):
+            if not _nonce_rejected(response):
+                break
+            response.content
+            response.close()
+            request = response.request.copy()
+            self.sign(request)
+            retry = response.connection.send(request, **kwargs)
+            retry.history.extend(response.history)
+            retry.history.append(response)
+            retry.request = request
+            response = retry
+        return response
+
+    def __call__(self, request):
+        self.sign(request)
+        request.register_hook('response', self.handle_response)
+        return request
+
+
+def _allocate(path, count, queue):
+    nonces = NonceAllocator(path)
+    queue.put([nonces.next() for _ in range(count)])
+    nonces.close()
+
+
+class _NonceAdapter(BaseAdapter):
+    """Accepts a nonce only above the last accepted one, like Bitso."""
+
+    def __init__(self):
+        super().__init__()
+        self.last = 0
+        self.nonces = []
+
+    def send(self, request, **kwargs):
+        nonce = int(request.headers['Authorization'].split(':')[1])
+        self.nonces.append(nonce)
+        response = Response()
+        response.headers = CaseInsensitiveDict({'Content-Type': 'application/json'})
+        if nonce > self.last:
+            self.last = nonce
+            response.status_code = 200
+            response._content = b'{"success": true, "payload": {}}'
+        else:
+            response.status_code = 400
+            response._content = b'{"success": false, "error": {"code": "0201", "message": "Invalid Nonce"}}'
+        response.request = request
+        response.connection = self
+        return response
+
+    def close(self):
+        pass
+
+
+class TestSigning(unittest.TestCase):
+
+    def test_monotonic_when_clock_stalls_or_goes_back(self):
+        now = [1.0]
+        nonces = NonceAllocator(clock=lambda: now[0])
+        first = nonces.next()
+        second = nonces.next()
+        now[0] = 0.5
+        third = nonces.next()
+        self.assertLess(first, second)
+        self.assertLess(second, third)
+
+    def test_unique_across_threads(self):
+        nonces = NonceAllocator(clock=lambda: 1.0)
+        results = [[] for _ in range(8)]
+
+        def work(out):
+            for _ in range(1000):
+                out.append(nonces.next())
+
+        threads = [threading.Thread(target=work, args=(out,)) for out in results]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        flat = [nonce for out in results for nonce in out]
+        self.assertEqual(len(set(flat)), len(flat))
+        for out in results:
+            self.assertEqual(out, sorted(out))
+
+    def test_unique_across_processes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'nonce')
+            context = multiprocessing.get_context('fork')
+            queue = context.Queue()
+            workers = [context.Process(target=_allocate, args=(path, 2000, queue)) for _ in range(4)]
+            for worker in workers:
+                worker.start()
+            batches = [queue.get(timeout=30) for _ in workers]
+            for worker in workers:
+                worker.join()
+            flat = [nonce for batch in batches for nonce in batch]
+            self.assertEqual(len(set(flat)), len(flat))
+            for batch in batches:
+                self.assertEqual(batch, sorted(batch))
+
+    def test_auth_signs_at_send_time(self):
+        adapter = _NonceAdapter()
+        session = Session()
+        session.mount('https://', adapter)
+        auth = BitsoAuth(Signer({'public': 'pub', 'private': 'secret'}))
+        first = Request('GET', 'https://x/api/v3/balance/', auth=auth)
+        second = Request('GET', 'https://x/api/v3/balance/', auth=auth)
+        # built in one order, sent in the other
+        session.send(session.prepare_request(second))
+        session.send(session.prepare_request(first))
+        self.assertEqual(adapter.nonces, sorted(adapter.nonces))
+
+    def test_nonce_rejection_is_resigned(self):
+        adapter = _NonceAdapter()
+        session = Session()
+        session.mount('https://', adapter)
+        auth = BitsoAuth(Signer({'public': 'pub', 'private': 'secret'}, NonceAllocator(clock=lambda: 0)))
+        # another worker already got nonce 2 through
+        adapter.last = 2
+        response = session.send(session.prepare_request(
+            Request('POST', 'https://x/api/v3/orders/', data=b'{}', auth=auth)))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(adapter.nonces, [1, 2, 3])
+        self.assertEqual([r.status_code for r in response.history], [400, 400])
+        # past `retries` the last rejection comes back
+        adapter.last = 100
+        response = session.send(session.prepare_request(
+            Request('POST', 'https://x/api/v3/orders/', data=b'{}', auth=auth)))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(adapter.nonces[3:], [4, 5, 6, 7])
+
+    def test_signature_matches_reference(self):
+        key = {'public': 'pub', 'private': 'secret'}
+        signer = Signer(key, NonceAllocator(clock=lambda: 1.5))
+        header = signer.sign('POST', '/api/v3/orders/', b'{"book": "btc_mxn"}')
+        public, nonce, signature = header[len('Bitso '):].split(':')
+        expected = hmac.new(b'secret', f'{nonce}POST/api/v3/orders/{{"book": "btc_mxn"}}'.encode('utf-8'),
+                            hashlib.sha256).hexdigest()
+        self.assertEqual(public, 'pub')
+        self.assertEqual(nonce, '1500000')
+        self.assertEqual(signature, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
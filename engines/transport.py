@@ -0,0 +1,226 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from urllib.parse import urlparse, parse_qsl
+from requests import Request, Session, ConnectionError
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+
+
+def request_key(request):
+    """
+    Identify a prepared request by method, path, sorted query and body. The
+    Authorization header (nonce and signature) is left out on purpose so a
+    recording matches however many times the request is re-signed.
+    """
+    parsed = urlparse(request.url)
+    query = sorted(parse_qsl(parsed.query, keep_blank_values=True))
+    body = request.body or ''
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+    if body:
+        try:
+            body = json.dumps(json.loads(body), sort_keys=True)
+        except ValueError:
+            pass
+    return f"{request.method} {parsed.path}?{'&'.join(f'{k}={v}' for k, v in query)} {body}".strip()
+
+
+class Cassette(object):
+    """
+    Recorded responses keyed by request_key, replayed in recording order.
+    Top level keys starting with '_' are notes about the cassette (request
+    keys always start with the method) and are kept in `notes`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.interactions = {}
+        self.notes = {}
+        self.positions = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.interactions = json.load(f)
+            self.notes = {key: self.interactions.pop(key) for key in list(self.interactions) if key.startswith('_')}
+
+    @property
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def add(self, key, response):
+        self.interactions.setdefault(key, []).append({
+            'status_code': response.status_code,
+            'reason': response.reason,
+            'headers': {'Content-Type': response.headers.get('Content-Type', 'application/json')},
+            'body': response.content.decode('utf-8'),
+        })
+
+    def next(self, key):
+        # once a key runs out its last response is repeated, polling loops
+        # keep seeing the final recorded state
+        recorded = self.interactions.get(key)
+        if not recorded:
+            return None
+        position = self.positions.get(key, 0)
+        self.positions[key] = position + 1
+        return recorded[min(position, len(recorded) - 1)]
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump(dict(self.interactions, **self.notes), f, indent=2, sort_keys=True)
+
+
+class RecordingAdapter(BaseAdapter):
+    """Sends requests through `inner` (real HTTP by default) and keeps every response."""
+
+    def __init__(self, cassette, inner=None):
+        super().__init__()
+        self.cassette = cassette
+        self.inner = inner or HTTPAdapter()
+
+    def send(self, request, **kwargs):
+        response = self.inner.send(request, **kwargs)
+        self.cassette.add(request_key(request), response)
+        return response
+
+    def close(self):
+        self.inner.close()
+
+
+class ReplayAdapter(BaseAdapter):
+    """Serves responses from the cassette, optionally after `latency` seconds."""
+
+    def __init__(self, cassette, latency=0):
+        super().__init__()
+        self.cassette = cassette
+        self.latency = latency
+
+    def send(self, request, **kwargs):
+        key = request_key(request)
+        recorded = self.cassette.next(key)
+        if recorded is None:
+            raise ConnectionError(f"No recorded response for {key} in {self.cassette.path}", request=request)
+        if self.latency:
+            time.sleep(self.latency)
+        response = Response()
+        response.status_code = recorded['status_code']
+        response.reason = recorded.get('reason')
+        response.headers = CaseInsensitiveDict(recorded.get('headers', {}))
+        response._content = recorded['body'].encode('utf-8')
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def make_session(adapter):
+    session = Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def use_cassette(engine, name, mode=None, directory='cassettes', latency=0):
+    """
+    Point the engine at a cassette. `mode` (or BITSO_TRANSPORT) is 'record',
+    'replay' or 'live'; by default an existing cassette is replayed and a
+    missing one means live. Returns (mode, cassette), call cassette.save()
+    after recording.
+    """
+    cassette = Cassette(os.path.join(directory, f"{name}.json"))
+    mode = mode or os.getenv('BITSO_TRANSPORT') or ('replay' if cassette.exists else 'live')
+    latency = float(os.getenv('BITSO_REPLAY_LATENCY', latency))
+    if mode == 'record':
+        engine.set_transport(RecordingAdapter(cassette))
+    elif mode == 'replay':
+        engine.set_transport(ReplayAdapter(cassette, latency))
+    return mode, cassette
+
+
+class _StaticAdapter(BaseAdapter):
+
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def send(self, request, **kwargs):
+        self.calls += 1
+        response = Response()
+        response.status_code = 200
+        response.headers = CaseInsensitiveDict({'Content-Type': 'application/json'})
+        response._content = json.dumps({'success': True, 'payload': {'call': self.calls}}).encode('utf-8')
+        response.request = request
+        response.url = request.url
+        return response
+
+    def close(self):
+        pass
+
+
+class TestTransport(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'cassette.json')
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        self.dir.cleanup()
+        return super().tearDown()
+
+    def test_key_ignores_signature_and_param_order(self):
+        session = Session()
+        a = session.prepare_request(Request(
+            'GET', 'https://x/api/v3/order_book/', params={'book': 'btc_mxn', 'aggregate': True},
+            headers={'Authorization': 'Bitso pub:1:abc'}))
+        b = session.prepare_request(Request(
+            'GET', 'https://x/api/v3/order_book/', params={'aggregate': True, 'book': 'btc_mxn'},
+            headers={'Authorization': 'Bitso pub:2:def'}))
+        self.assertEqual(request_key(a), request_key(b))
+
+    def test_record_then_replay_in_order(self):
+        cassette = Cassette(self.path)
+        session = make_session(RecordingAdapter(cassette, _StaticAdapter()))
+        session.get('https://x/api/v3/balance/')
+        session.get('https://x/api/v3/balance/')
+        cassette.save()
+
+        replay = make_session(ReplayAdapter(Cassette(self.path)))
+        calls = [replay.get('https://x/api/v3/balance/').json()['payload']['call'] for _ in range(3)]
+        self.assertEqual(calls, [1, 2, 2])
+
+    def test_notes_are_not_requests(self):
+        cassette = Cassette(self.path)
+        cassette.notes['_note'] = 'synthetic'
+        make_session(RecordingAdapter(cassette, _StaticAdapter())).get('https://x/api/v3/ticker/')
+        cassette.save()
+        replayed = Cassette(self.path)
+        self.assertEqual(list(replayed.interactions), ['GET /api/v3/ticker/?'])
+        self.assertEqual(replayed.notes, {'_note': 'synthetic'})
+
+    def test_replay_unknown_request_fails(self):
+        Cassette(self.path).save()
+        session = make_session(ReplayAdapter(Cassette(self.path)))
+        with self.assertRaises(ConnectionError):
+            session.get('https://x/api/v3/ticker/')
+
+    def test_replay_latency(self):
+        cassette = Cassette(self.path)
+        make_session(RecordingAdapter(cassette, _StaticAdapter())).get('https://x/api/v3/ticker/')
+        session = make_session(ReplayAdapter(cassette, latency=0.05))
+        start = time.monotonic()
+        session.get('https://x/api/v3/ticker/')
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()
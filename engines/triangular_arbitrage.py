@@ -1,15 +1,21 @@
 from datetime import datetime, timedelta
 import unittest
-import grequests
 import json
 import time
 import logging.handlers
 import pyfiglet
 from logging.handlers import TimedRotatingFileHandler
 import os
+import math
+import tempfile
 import traceback
+from dotenv import load_dotenv
 from engines.alerts import Alerts
+from engines.journal import Journal
+from engines.allocator import CapitalAllocator, Cycle, Leg
 from engines.bitso import ExchangeEngine
+from engines.transport import use_cassette
+from engines.cross_venue import MockVenue
 
 # Title
 title = "Bitso API Bot"
@@ -51,11 +57,13 @@ def printwt(msg):
     logger.info(f"{datetime.utcnow()} :: {msg}")
 
 
-def _send_requests(requests):
-    responses = grequests.map(requests)
-    for response in responses:
-        if not response:
-            logger.error(response.json())
+def _send_requests(engine, requests):
+    responses = engine.map(requests)
+    for req, response in zip(requests, responses):
+        if response is None:
+            logger.error(f"{req.method} {req.url} failed or timed out")
+        elif not response:
+            logger.error(f"{req.method} {req.url} returned {response.status_code}: {response.text}")
     return responses
 
 
@@ -74,14 +82,43 @@ class CryptoEngineTriArbitrage(object):
         self.open_orders = True
         self.openOrderCheckCount = 0
         self.engine = engine
-        self.book_info = grequests.map(
-            [
-                self.engine.get_available_books(
-                    books=[self.tickerPairA, self.tickerPairB, self.tickerPairC]
-                )
-            ]
-        )[0].parsed
+        # seconds to wait before retrying a request that failed or timed out
+        self.retry_delay = 5
+        # the allocator splits balances across the routes of every triangle,
+        # each given as (x_quote, x_y, y_quote) like tickerPairA/B/C
+        self.triangles = [
+            tuple(triangle) for triangle in config.get("triangles", [self.tickerPairs])
+        ]
+        for a, b, c in self.triangles:
+            x, quote = a.split("_")
+            y = c.split("_")[0]
+            if b != f"{x}_{y}" or c != f"{y}_{quote}":
+                raise ValueError(f"Triangle {a}, {b}, {c} is not (x_quote, x_y, y_quote)")
+        self.books = list(dict.fromkeys(
+            self.tickerPairs + [book for triangle in self.triangles for book in triangle]
+        ))
+        self.book_info = self.load_book_info()
         self.trade_limit = 10
+        # rolling statistics window (samples) and how many leg volatilities
+        # the route must clear on top of break-even before trading
+        self.history_window = config.get("historyWindow", 120)
+        self.volatility_margin = config.get("volatilityMargin", 0)
+        self.triangle = "-".join(self.tickerPairs)
+        self.journal = Journal(config["journalFile"]) if config.get("journalFile") else None
+        # split balances across every profitable route instead of taking the best one
+        self.use_allocator = config.get("useAllocator", False)
+        self.depth_levels = config.get("depthLevels", 20)
+        # seconds to wait after placing orders; the allocator only spends
+        # free balances, so it can keep trading while earlier orders rest
+        self.placement_cooldown = config.get("placementCooldown", 300)
+        self.open_order_count = 0
+        self.allocator = CapitalAllocator(self.book_info)
+        self.expected_open_orders = 3
+        # journal route key of each order returned by the last check
+        self.order_routes = []
+        # orders placed by this bot that may still be on the book, by oid;
+        # their fills are journaled once they leave it
+        self.placed_orders = {}
         self.balance_log = None
         # email alerts
         load_dotenv()
@@ -106,14 +143,20 @@ class CryptoEngineTriArbitrage(object):
             if n_of_trades >= self.trade_limit:
                 break
             if self.open_orders:
-                self.check_open_orders()
-            else:
-                opportunities = self.check_order_book()
+                self.check_open_orders(wait=not self.use_allocator)
+            if self.use_allocator or not self.open_orders:
+                if self.use_allocator:
+                    opportunities = self.check_order_book_allocated()
+                else:
+                    opportunities = self.check_order_book()
                 if opportunities:
                     printwt("------- Opportunities -------")
                     printwt(opportunities)
                     if not self.mock:
                         orders, responses = self.place_orders(opportunities)
+                        if not self.orders_placed(responses):
+                            self.cancel_placed_legs(opportunities, responses)
+                            continue
                         printwt("------- Placed Orders -------")
                         printwt(opportunities)
                         body = f"""
@@ -125,39 +168,98 @@ class CryptoEngineTriArbitrage(object):
                         )
                         self.open_orders = True
                         n_of_trades += 1
-                        time.sleep(300)
+                        time.sleep(self.placement_cooldown)
                     else:
                         printwt("------- No orders placed for Mock mode -------")
                     printwt("------- Balance after trade -------")
                     printwt(self.get_balances())
                     time.sleep(5)
 
+    def load_book_info(self, attempts=5):
+        for _ in range(attempts):
+            res = _send_requests(
+                self.engine,
+                [self.engine.get_available_books(books=self.books)],
+            )[0]
+            if res is not None:
+                return res.parsed
+            time.sleep(self.retry_delay)
+        raise RuntimeError(f"Could not load available books after {attempts} attempts")
+
+    def fetch_balances(self):
+        res = _send_requests(
+            self.engine,
+            [self.engine.get_balance(tickers=[self.tickerA, self.tickerB, self.tickerC])],
+        )[0]
+        return res.parsed if res is not None else None
+
     def get_balances(self):
-        return grequests.map(
-            [
-                self.engine.get_balance(
-                    tickers=[self.tickerA, self.tickerB, self.tickerC]
-                )
-            ]
-        )[0].parsed
+        balances = self.fetch_balances()
+        if balances is None:
+            return None
+        if self.journal:
+            self.journal.record_balances(balances)
+        return balances
+
+    def route_key(self, route):
+        return f"{self.triangle}:{route}"
+
+    def journal_opportunity(self, route, value, threshold, status, books, orders=None):
+        if self.journal:
+            self.journal.record_opportunity(
+                self.route_key(route), value, threshold, status, books, orders
+            )
 
-    def check_open_orders(self):
-        orders = grequests.map([self.engine.list_open_orders()])[0].json()["payload"]
+    def check_open_orders(self, wait=True):
+        res = _send_requests(self.engine, [self.engine.list_open_orders()])[0]
+        orders = res.parsed if res is not None else None
+        if orders is None:
+            # keep the current state and look again after a pause
+            time.sleep(self.retry_delay)
+            return
+        self.open_order_count = len(orders)
+        self.record_fills({order["oid"] for order in orders})
         # too many orders, something went wrong, cancel all orders
-        if len(orders) > 3:
-            self.engine.cancel_all_orders()
+        if len(orders) > self.expected_open_orders:
+            _send_requests(self.engine, [self.engine.cancel_all_orders()])
             self.open_orders = False
+            self.open_order_count = 0
+            self.record_fills(set())
             return
         # no orders
         if len(orders) == 0:
             self.open_orders = False
             return
         # some orders have been filled but orders still pending
-        if 0 < len(orders) < 3:
+        if 0 < len(orders) < self.expected_open_orders:
             self.open_orders = True
             self.print_open_orders(orders)
-            time.sleep(300)
+            if wait:
+                time.sleep(self.placement_cooldown)
+            return
+
+    def record_fills(self, open_oids):
+        """
+        Look up the placed orders that are no longer in `open_oids` and
+        journal what they filled. Orders whose lookup fails are kept and
+        looked up again on the next check.
+        """
+        gone = [oid for oid in self.placed_orders if oid not in open_oids]
+        if not gone or not self.journal:
+            for oid in gone:
+                del self.placed_orders[oid]
             return
+        lookups = _send_requests(self.engine, [self.engine.lookup_order(oid) for oid in gone])
+        for oid, res in zip(gone, lookups):
+            if res is None or res.parsed is None:
+                continue
+            del self.placed_orders[oid]
+            for order in res.parsed:
+                filled = order["original_amount"] - order["amount"]
+                if filled > 0:
+                    self.journal.record_fill(
+                        order["book"], order["side"], order["price"], filled, oid=oid
+                    )
 
     def print_open_orders(self, orders):
         current_datetime = datetime.now()
@@ -172,9 +274,9 @@ class CryptoEngineTriArbitrage(object):
                 printwt(orders)
 
     def get_bid_route(self, books, fees):
-        fee_factor1 = 1 - float(fees[self.tickerPairA]["taker_fee_decimal"]) / 100
-        fee_factor2 = 1 - float(fees[self.tickerPairB]["taker_fee_decimal"]) / 100
-        fee_factor3 = 1 - float(fees[self.tickerPairC]["taker_fee_decimal"]) / 100
+        fee_factor1 = 1 - fees[self.tickerPairA]["taker_fee"]
+        fee_factor2 = 1 - fees[self.tickerPairB]["taker_fee"]
+        fee_factor3 = 1 - fees[self.tickerPairC]["taker_fee"]
         # bid route
         bid_route = (
             (1 / books[0]["ask"]["price"])
@@ -185,9 +287,9 @@ class CryptoEngineTriArbitrage(object):
         return bid_route
 
     def get_ask_route(self, books, fees):
-        fee_factor1 = 1 - float(fees[self.tickerPairA]["taker_fee_decimal"]) / 100
-        fee_factor2 = 1 - float(fees[self.tickerPairB]["taker_fee_decimal"]) / 100
-        fee_factor3 = 1 - float(fees[self.tickerPairC]["taker_fee_decimal"]) / 100
+        fee_factor1 = 1 - fees[self.tickerPairA]["taker_fee"]
+        fee_factor2 = 1 - fees[self.tickerPairB]["taker_fee"]
+        fee_factor3 = 1 - fees[self.tickerPairC]["taker_fee"]
         # bid route
         ask_route = (
             (1 / books[2]["ask"]["price"])
@@ -197,33 +299,61 @@ class CryptoEngineTriArbitrage(object):
         ask_route = ask_route * fee_factor1 * fee_factor2 * fee_factor3
         return ask_route
 
+    def get_route_threshold(self, books=None):
+        if not self.volatility_margin:
+            return 1
+        volatilities = [
+            self.engine.history.volatility(book, self.history_window)
+            for book in books or self.tickerPairs
+        ]
+        volatilities = [v for v in volatilities if not math.isnan(v)]
+        if not volatilities:
+            return 1
+        return 1 + self.volatility_margin * max(volatilities)
+
     def check_order_book(self):
         rs = [
             self.engine.get_order_book_innermost(book=self.tickerPairA),
             self.engine.get_order_book_innermost(book=self.tickerPairB),
             self.engine.get_order_book_innermost(book=self.tickerPairC),
         ]
-        books = [res.parsed for res in _send_requests(rs)]
+        responses = _send_requests(self.engine, rs)
+        # a book that timed out or tripped its breaker skips this tick
+        if any(res is None for res in responses):
+            return None
+        books = [res.parsed for res in responses]
         # check that there a re bids and asks
         for book in books:
             if "bid" not in book or "ask" not in book:
                 return None
-        fees = grequests.map(
+        fees = _send_requests(
+            self.engine,
             [
                 self.engine.list_fees(
                     books=[self.tickerPairA, self.tickerPairB, self.tickerPairC]
                 )
-            ]
-        )[0].parsed
+            ],
+        )[0]
+        if fees is None:
+            return None
+        fees = fees.parsed
         # bid route
         bid_route = self.get_bid_route(books, fees)
         ask_route = self.get_ask_route(books, fees)
-        printwt(f"Bid route: {bid_route}; Ask route: {ask_route}")
-        if bid_route > 1 or ask_route > 1:
+        self.engine.history.append_route("bid", bid_route)
+        self.engine.history.append_route("ask", ask_route)
+        threshold = self.get_route_threshold()
+        printwt(f"Bid route: {bid_route}; Ask route: {ask_route}; Threshold: {threshold}")
+        if bid_route > threshold or ask_route > threshold:
             if bid_route > ask_route:
                 max_amounts = self.get_max_amounts_bid_route(books)
+                if max_amounts is None:
+                    return None
                 if not self.validate_max_amounts(max_amounts):
                     printwt("Can't make trade, amounts too low")
+                    self.journal_opportunity(
+                        "bid", bid_route, threshold, "amounts too low", books
+                    )
                     return None
                 max_amounts = self.top_max_amounts(max_amounts)
                 orders = [
@@ -249,12 +379,21 @@ class CryptoEngineTriArbitrage(object):
                         "type": "limit",
                     },
                 ]
+                self.journal_opportunity(
+                    "bid", bid_route, threshold, "found", books, orders
+                )
+                self.order_routes = [self.route_key("bid")] * len(orders)
                 return orders
             else:
                 printwt("------- Route -------")
                 max_amounts = self.get_max_amounts_ask_route(books)
+                if max_amounts is None:
+                    return None
                 if not self.validate_max_amounts(max_amounts):
                     printwt("Can't make trade, amounts too low")
+                    self.journal_opportunity(
+                        "ask", ask_route, threshold, "amounts too low", books
+                    )
                     return None
                 max_amounts = self.top_max_amounts(max_amounts)
                 orders = [
@@ -280,7 +419,22 @@ class CryptoEngineTriArbitrage(object):
                         "type": "limit",
                     },
                 ]
+                self.journal_opportunity(
+                    "ask", ask_route, threshold, "found", books, orders
+                )
+                self.order_routes = [self.route_key("ask")] * len(orders)
                 return orders
+        elif bid_route > 1 or ask_route > 1:
+            # profitable but inside the volatility margin, keep a record of the skip
+            if bid_route > ask_route:
+                self.journal_opportunity(
+                    "bid", bid_route, threshold, "below threshold", books
+                )
+            else:
+                self.journal_opportunity(
+                    "ask", ask_route, threshold, "below threshold", books
+                )
+            return None
         else:
             return None
 
@@ -314,13 +468,9 @@ class CryptoEngineTriArbitrage(object):
     def get_max_amounts_ask_route(self, books):
         # sell eth for btc -> sell btc for mxn -> buy eth with mxn
         # get balances
-        balances = grequests.map(
-            [
-                self.engine.get_balance(
-                    tickers=[self.tickerA, self.tickerB, self.tickerC]
-                )
-            ]
-        )[0].parsed
+        balances = self.fetch_balances()
+        if balances is None:
+            return None
         max_amount_eth_mxn = self.calculate_max_amount(
             books[0], balances, "bid", "sell"
         )
@@ -333,13 +483,9 @@ class CryptoEngineTriArbitrage(object):
 
     def get_max_amounts_bid_route(self, books):
         # sell eth for mx -> buy btc with mxn -> buy eth with btc
-        balances = grequests.map(
-            [
-                self.engine.get_balance(
-                    tickers=[self.tickerA, self.tickerB, self.tickerC]
-                )
-            ]
-        )[0].parsed
+        balances = self.fetch_balances()
+        if balances is None:
+            return None
         max_amount_eth_mxn = self.calculate_max_amount(books[0], balances, "ask", "buy")
         max_amount_eth_btc = self.calculate_max_amount(
             books[1], balances, "bid", "sell"
@@ -365,31 +511,369 @@ class CryptoEngineTriArbitrage(object):
         return round(amount_to_trade, 8)
 
     def place_orders(self, orders):
-        orders = [
-            self.engine.place_order(orders[0]),
-            self.engine.place_order(orders[1]),
-            self.engine.place_order(orders[2]),
+        bodies = orders
+        orders = [self.engine.place_order(order) for order in bodies]
+        order_responses = [
+            res.parsed if res is not None else None
+            for res in _send_requests(self.engine, orders)
         ]
-        order_responses = [res.json() for res in _send_requests(orders)]
+        if self.journal:
+            routes = self.order_routes or [None] * len(bodies)
+            for body, response, route in zip(bodies, order_responses, routes):
+                self.journal.record_order(body, response, route=route)
+        self.placed_orders.update(
+            (response["oid"], body) for body, response in zip(bodies, order_responses)
+            if response is not None
+        )
         self.open_orders = True
+        # orders from earlier placements may still rest on the allocator path
+        self.expected_open_orders = self.open_order_count + len(orders)
         return orders, order_responses
 
+    def orders_placed(self, responses):
+        return all(res is not None for res in responses)
+
+    def cancel_placed_legs(self, orders, responses):
+        # some legs failed, cancel the ones that went through so the route is
+        # not left half open; legs that already filled need a manual look
+        logger.error(f"Order placement failed, responses: {responses}")
+        oids = [res["oid"] for res in responses if res is not None]
+        cancels = _send_requests(
+            self.engine, [self.engine.cancel_order(oid) for oid in oids]
+        )
+        body = f"""
+        Orders: {json.dumps(orders, indent=4)},
+        Responses: {json.dumps(responses, indent=4)},
+        Cancelled: {[oid for oid, res in zip(oids, cancels) if res is not None and res.parsed]}
+        """
+        self.alertsservice.email_alert(self.emailto, "Order Placement Failed", body)
+
+    def get_cycles(self, depths, fees):
+        """Bid and ask cycles of every triangle whose books all have depth."""
+        def leg(book, side):
+            levels = depths[book]["asks" if side == "buy" else "bids"]
+            return Leg(book, side, levels, fees[book]["taker_fee"])
+
+        cycles = []
+        for a, b, c in self.triangles:
+            if not all(depths[book]["bids"] and depths[book]["asks"] for book in (a, b, c)):
+                continue
+            name = "-".join((a, b, c))
+            start = a.split("_")[1]
+            # bid route: buy A, sell B, sell C; ask route: buy C, buy B, sell A
+            cycles.append(Cycle(f"{name}:bid", start, [leg(a, "buy"), leg(b, "sell"), leg(c, "sell")]))
+            cycles.append(Cycle(f"{name}:ask", start, [leg(c, "buy"), leg(b, "buy"), leg(a, "sell")]))
+        return cycles
+
+    def check_order_book_allocated(self):
+        currencies = list(dict.fromkeys(
+            currency for book in self.books for currency in book.split("_")
+        ))
+        rs = [
+            self.engine.get_order_book_depth(book=book, levels=self.depth_levels)
+            for book in self.books
+        ]
+        rs.append(self.engine.list_fees(books=self.books))
+        rs.append(self.engine.get_balance(tickers=currencies))
+        responses = _send_requests(self.engine, rs)
+        if any(res is None for res in responses):
+            return None
+        depths = {book: res.parsed for book, res in zip(self.books, responses)}
+        fees, balances = responses[-2].parsed, responses[-1].parsed
+        threshold = self.get_route_threshold(self.books)
+        allocations = self.allocator.allocate(
+            self.get_cycles(depths, fees), balances, threshold
+        )
+        orders = []
+        self.order_routes = []
+        for allocation in allocations:
+            printwt(
+                f"Route {allocation['cycle']}: input {allocation['input']}, "
+                f"expected profit {allocation['profit']}"
+            )
+            if self.journal:
+                self.journal.record_opportunity(
+                    allocation["cycle"], 1 + allocation["profit"] / allocation["input"], threshold,
+                    "allocated", depths, allocation["orders"],
+                )
+            orders += allocation["orders"]
+            self.order_routes += [allocation["cycle"]] * len(allocation["orders"])
+        return orders
+
+
+class _PlacementResponse(object):
+
+    def __init__(self, parsed):
+        self.parsed = parsed
+
+
+class _PlacementRequest(object):
+
+    def __init__(self, method, url):
+        self.method = method
+        self.url = url
+
+
+class _PlacementEngine(object):
+
+    def __init__(self, results):
+        self.results = results
+        self.cancelled = []
+
+    def place_order(self, body):
+        return _PlacementRequest("POST", "orders")
+
+    def cancel_order(self, oid):
+        self.cancelled.append(oid)
+        return _PlacementRequest("DELETE", f"orders/{oid}")
+
+    def list_open_orders(self, book=None):
+        return _PlacementRequest("GET", "open_orders")
+
+    def get_balance(self, tickers=[]):
+        return _PlacementRequest("GET", "balance")
+
+    def map(self, requests):
+        if requests and requests[0].method == "DELETE":
+            return [_PlacementResponse([req.url.split("/")[-1]]) for req in requests]
+        return [
+            None if r is None else _PlacementResponse(None if r is _REJECTED else r)
+            for r in self.results
+        ]
+
+
+# a request the venue answered but rejected, `.parsed` is None
+_REJECTED = object()
+
+
+class _PlacementAlerts(object):
+
+    def __init__(self):
+        self.subjects = []
+
+    def email_alert(self, to, subject, body):
+        self.subjects.append(subject)
+
+
+class TestOrderPlacement(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.arb = object.__new__(CryptoEngineTriArbitrage)
+        self.arb.journal = None
+        self.arb.open_order_count = 0
+        self.arb.placed_orders = {}
+        self.arb.emailto = None
+        self.arb.alertsservice = _PlacementAlerts()
+        self.orders = [{"book": b} for b in ["eth_mxn", "eth_btc", "btc_mxn"]]
+        return super().setUp()
+
+    def test_partial_placement_cancels_placed_legs(self):
+        self.arb.engine = _PlacementEngine(
+            [{"oid": "a"}, None, _REJECTED]
+        )
+        _, responses = self.arb.place_orders(self.orders)
+        self.assertFalse(self.arb.orders_placed(responses))
+        self.arb.cancel_placed_legs(self.orders, responses)
+        self.assertEqual(self.arb.engine.cancelled, ["a"])
+        self.assertEqual(self.arb.alertsservice.subjects, ["Order Placement Failed"])
+
+    def test_full_placement(self):
+        self.arb.engine = _PlacementEngine(
+            [{"oid": oid} for oid in "abc"]
+        )
+        _, responses = self.arb.place_orders(self.orders)
+        self.assertTrue(self.arb.orders_placed(responses))
+
+    def test_failed_reads_keep_state(self):
+        self.arb.engine = _PlacementEngine([None])
+        self.arb.retry_delay = 0
+        self.arb.tickerA, self.arb.tickerB, self.arb.tickerC = "mxn", "eth", "btc"
+        self.arb.open_orders = True
+        self.arb.check_open_orders()
+        self.assertTrue(self.arb.open_orders)
+        self.assertIsNone(self.arb.get_balances())
+        self.assertIsNone(self.arb.get_max_amounts_bid_route([]))
+
+    def test_orders_journaled_under_opportunity_route(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.arb.journal = Journal(os.path.join(directory, "journal.db"))
+            self.arb.triangle = "eth_mxn-eth_btc-btc_mxn"
+            self.arb.order_routes = [self.arb.route_key("bid")] * 3
+            self.arb.engine = _PlacementEngine(
+                [{"oid": oid} for oid in "abc"]
+            )
+            orders = [dict(order, side="buy", price=1.0, major=1.0) for order in self.orders]
+            self.arb.place_orders(orders)
+            self.arb.journal.close()
+            routes = {row[1] for row in self.arb.journal.orders()}
+            self.assertEqual(routes, {"eth_mxn-eth_btc-btc_mxn:bid"})
+
+
+class TestOtherVenue(unittest.TestCase):
+
+    def test_strategy_runs_on_any_engine(self):
+        quote = lambda bid, ask: {
+            "bid": {"price": bid, "amount": 1.0}, "ask": {"price": ask, "amount": 1.0}
+        }
+        venue = MockVenue("mock", {
+            "eth_mxn": quote(39990, 40000),
+            "eth_btc": quote(0.0575, 0.0576),
+            "btc_mxn": quote(715000, 715100),
+        }, fee=0.001, balances={"mxn": 10000.0, "eth": 1.0, "btc": 0.1})
+        config = {
+            "tickerPairA": "eth_mxn", "tickerPairB": "eth_btc", "tickerPairC": "btc_mxn",
+            "tickerA": "mxn", "tickerB": "eth", "tickerC": "btc",
+        }
+        arb = CryptoEngineTriArbitrage(config, venue)
+        orders = arb.check_order_book()
+        self.assertEqual([order["side"] for order in orders], ["buy", "sell", "sell"])
+        _, responses = arb.place_orders(orders)
+        self.assertTrue(arb.orders_placed(responses))
+        arb.check_open_orders()
+        self.assertTrue(arb.open_orders)
+
+    def test_fills_journaled_when_orders_leave_the_book(self):
+        venue = MockVenue("mock", {}, balances={})
+        arb = object.__new__(CryptoEngineTriArbitrage)
+        arb.engine = venue
+        arb.open_order_count = 0
+        arb.order_routes = []
+        arb.placed_orders = {}
+        arb.balance_log = None
+        arb.retry_delay = arb.placement_cooldown = 0
+        orders = [
+            {"book": "eth_mxn", "side": "buy", "type": "limit", "price": 40000.0, "major": 0.1},
+            {"book": "eth_btc", "side": "sell", "type": "limit", "price": 0.057, "major": 0.1},
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            arb.journal = Journal(os.path.join(directory, "journal.db"))
+            _, responses = arb.place_orders(orders)
+            venue.fill(responses[0]["oid"])
+            arb.check_open_orders(wait=False)
+            self.assertEqual(list(arb.placed_orders), [responses[1]["oid"]])
+            # cancelled without filling, nothing to journal
+            _send_requests(venue, [venue.cancel_order(responses[1]["oid"])])
+            arb.check_open_orders(wait=False)
+            self.assertEqual(arb.placed_orders, {})
+            arb.journal.close()
+            fills = arb.journal.query("SELECT oid, book, side, price, amount FROM fills")
+        self.assertEqual(fills, [(responses[0]["oid"], "eth_mxn", "buy", 40000.0, 0.1)])
+
+
+class TestAllocatedOrderBook(unittest.TestCase):
+
+    def setUp(self) -> None:
+        quote = lambda bid, ask, amount: {
+            "bid": {"price": bid, "amount": amount}, "ask": {"price": ask, "amount": amount}
+        }
+        self.venue = MockVenue("mock", {
+            "eth_mxn": quote(39990, 40000, 1.0),
+            "eth_btc": quote(0.0575, 0.0576, 1.0),
+            "btc_mxn": quote(715000, 715100, 1.0),
+            "xrp_mxn": quote(10.36, 10.37, 2000.0),
+            "xrp_btc": quote(0.0000148, 0.0000149, 2000.0),
+        }, fee=0.001, balances={"mxn": 100000.0, "eth": 10.0, "btc": 1.0, "xrp": 10000.0})
+        config = {
+            "tickerPairA": "eth_mxn", "tickerPairB": "eth_btc", "tickerPairC": "btc_mxn",
+            "tickerA": "mxn", "tickerB": "eth", "tickerC": "btc", "useAllocator": True,
+            "triangles": [["eth_mxn", "eth_btc", "btc_mxn"], ["xrp_mxn", "xrp_btc", "btc_mxn"]],
+        }
+        self.arb = CryptoEngineTriArbitrage(config, self.venue)
+        self.book_info = {book: {"minimum_amount": 0.001, "maximum_amount": 1000.0}
+                          for book in self.arb.books}
+        self.book_info["eth_mxn"]["maximum_amount"] = 0.5
+        self.book_info["xrp_mxn"]["minimum_amount"] = 10.0
+        self.arb.book_info = self.book_info
+        self.arb.allocator = CapitalAllocator(self.book_info)
+        return super().setUp()
+
+    def test_cycles_of_every_triangle(self):
+        depths = {book: self.venue.map([self.venue.get_order_book_depth(book)])[0].parsed
+                  for book in self.arb.books}
+        fees = self.venue.map([self.venue.list_fees(self.arb.books)])[0].parsed
+        cycles = {cycle.name: cycle for cycle in self.arb.get_cycles(depths, fees)}
+        self.assertEqual(set(cycles), {
+            "eth_mxn-eth_btc-btc_mxn:bid", "eth_mxn-eth_btc-btc_mxn:ask",
+            "xrp_mxn-xrp_btc-btc_mxn:bid", "xrp_mxn-xrp_btc-btc_mxn:ask",
+        })
+        ask = cycles["xrp_mxn-xrp_btc-btc_mxn:ask"]
+        self.assertEqual(ask.start, "mxn")
+        self.assertEqual([(leg.book, leg.side) for leg in ask.legs],
+                         [("btc_mxn", "buy"), ("xrp_btc", "buy"), ("xrp_mxn", "sell")])
+        self.assertEqual({leg.fee for cycle in cycles.values() for leg in cycle.legs}, {0.001})
+
+    def test_splits_balances_across_triangles(self):
+        orders = self.arb.check_order_book_allocated()
+        routes = dict.fromkeys(self.arb.order_routes)
+        self.assertEqual(list(sorted(routes)), [
+            "eth_mxn-eth_btc-btc_mxn:bid", "xrp_mxn-xrp_btc-btc_mxn:bid",
+        ])
+        for route in routes:
+            legs = [order for order, key in zip(orders, self.arb.order_routes) if key == route]
+            self.assertEqual([order["book"] for order in legs], route.split(":")[0].split("-"))
+            self.assertEqual([order["side"] for order in legs], ["buy", "sell", "sell"])
+        for order in orders:
+            info = self.book_info[order["book"]]
+            self.assertGreaterEqual(order["major"], info["minimum_amount"])
+            self.assertLessEqual(order["major"], info["maximum_amount"])
+
+    def test_invalid_triangle(self):
+        config = dict(self.arb.config, triangles=[["eth_mxn", "btc_mxn", "eth_btc"]])
+        with self.assertRaises(ValueError):
+            CryptoEngineTriArbitrage(config, self.venue)
+
 
 class TestTriangularArbitrage(unittest.TestCase):
+    # transport mode, None picks it from BITSO_TRANSPORT and the cassette
+    transport = None
 
     def setUp(self) -> None:
         f = open("arbitrage_config.json")
         arbitrage_config = json.load(f)
         f.close()
+        arbitrage_config["journalFile"] = None
         self.engine = ExchangeEngine(arbitrage_config["test_url"])
-        self.engine.load_key(arbitrage_config["test_keyFile"])
+        self.mode, self.cassette = use_cassette(
+            self.engine, f"{type(self).__name__}.{self._testMethodName}", self.transport
+        )
+        if self.mode == "replay" and not self.cassette.exists:
+            self.skipTest(f"no cassette at {self.cassette.path}")
+        if os.path.exists(arbitrage_config["test_keyFile"]):
+            self.engine.load_key(arbitrage_config["test_keyFile"])
+        elif self.mode == "replay":
+            self.engine.key = {"public": "replay", "private": "replay"}
+        else:
+            self.skipTest(f"no cassette recorded and no {arbitrage_config['test_keyFile']}")
         self.triangular_arb = CryptoEngineTriArbitrage(arbitrage_config, self.engine)
         return super().setUp()
 
+    def tearDown(self) -> None:
+        if self.mode == "record":
+            self.cassette.save()
+        return super().tearDown()
+
+    def test_check_order_book(self):
+        self.triangular_arb.mock = True
+        opportunities = self.triangular_arb.check_order_book()
+        self.assertIsNotNone(opportunities)
+        self.assertEqual(len(opportunities), 3)
+        self.assertEqual(
+            [order["book"] for order in opportunities], self.triangular_arb.tickerPairs
+        )
+        for order in opportunities:
+            self.assertGreater(order["major"], 0)
+
     def test_triangular_arbitrage(self):
+        if self.mode != "live":
+            self.skipTest("main_loop runs until trade_limit with real sleeps")
         self.triangular_arb.main_loop()
 
 
+class TestTriangularArbitrageSynthetic(TestTriangularArbitrage):
+    """Replays synthetic cassettes, hand-built rather than recorded."""
+    transport = "replay"
+
+
 if __name__ == "__main__":
     # run all tests
     # unittest.main()
@@ -1,6 +1,8 @@
 import json
-from engines.triangular_arbitrage import CryptoEngineTriArbitrage
+import os
+from engines.triangular_arbitrage import CryptoEngineTriArbitrage, logger
 from engines.bitso import ExchangeEngine
+from engines.profiling import ProfilingControl
 import argparse
 
 configFile = 'arbitrage_config.json'
@@ -11,19 +13,25 @@ with open(configFile) as f:
 
 parser = argparse.ArgumentParser(description="Run functions based on the command line arguments.")
 parser.add_argument('--prod', action='store_true', help="Run in production mode")
+parser.add_argument('--profile-dir', default='.',
+                    help="Where SIGUSR1 (sampling profiler) and SIGUSR2 (tracemalloc) write their reports")
 args = parser.parse_args()
 
+profiling = ProfilingControl(output_dir=args.profile_dir, logger=logger)
+profiling.install()
+print(f"PID: {os.getpid()} (kill -USR1 to toggle profiler, kill -USR2 to toggle tracemalloc)")
+
 f = open('arbitrage_config.json')
 arbitrage_config = json.load(f)
 f.close()
 if args.prod:
     print("ENV: prod")
-    engine = ExchangeEngine(arbitrage_config['url'])
+    engine = ExchangeEngine(arbitrage_config['url'], arbitrage_config.get('nonceFile'))
     engine.load_key(config['keyFile'])
     triangular_arb = CryptoEngineTriArbitrage(arbitrage_config, engine)
 else:
     print("ENV: test")
-    engine = ExchangeEngine(arbitrage_config['test_url'])
+    engine = ExchangeEngine(arbitrage_config['test_url'], arbitrage_config.get('nonceFile'))
     engine.load_key(config['test_keyFile'])
     triangular_arb = CryptoEngineTriArbitrage(arbitrage_config, engine)
 triangular_arb.main_loop()
\ No newline at end of file